@@ -0,0 +1,171 @@
+"""Throughput of the hottest server routes, sync versus async.
+
+Run with `python -m benchmarks.async_routes`. The sync variants are plain
+`def` routes with a synchronous session, which Starlette runs on its
+threadpool, like the API serves them. The async variants use the asyncio
+engine instead, which only pays off once they win here. Requests are sent
+straight into the ASGI app at several concurrency levels, against an SQLite
+database on disk."""
+
+import asyncio
+from datetime import datetime
+import json
+from pathlib import Path
+import tempfile
+import time
+
+from fastapi import Depends, FastAPI, HTTPException, status
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from metaserver import auth, config
+import metaserver.database.api as db
+from metaserver.database.models import Server
+from metaserver.schemas import ServerRead, ServerUpdate
+from benchmarks import utils
+
+requests_per_run = 400
+concurrency_levels = [1, 16, 128]
+servers = 50
+
+sync_app = FastAPI()
+async_app = FastAPI()
+
+
+@sync_app.get("/v1/server/list/online", response_model=list[ServerRead])
+def server_list_online(*, session: Session = Depends(db.get_session)):
+    return db.get_online_servers(
+        session,
+        cutoff=datetime.utcnow() - config.server_online_cutoff,
+    )
+
+
+@sync_app.post("/v1/server/update", response_model=ServerRead)
+def server_update(
+    server_update: ServerUpdate,
+    *,
+    session: Session = Depends(db.get_session),
+    server_id: int = Depends(auth.auth_server_id),
+):
+    if server := db.get_server_by_id_or_none(session, server_id):
+        return db.update_server(session, server, server_update)
+    raise HTTPException(status.HTTP_404_NOT_FOUND, "Server not found")
+
+
+@async_app.get("/v1/server/list/online", response_model=list[ServerRead])
+async def server_list_online_async(
+    *, session: AsyncSession = Depends(db.get_async_session)
+):
+    cutoff = datetime.utcnow() - config.server_online_cutoff
+    return (await session.exec(select(Server).where(Server.updated > cutoff))).all()
+
+
+@async_app.post("/v1/server/update", response_model=ServerRead)
+async def server_update_async(
+    server_update: ServerUpdate,
+    *,
+    session: AsyncSession = Depends(db.get_async_session),
+    server_id: int = Depends(auth.auth_server_id),
+):
+    if server := await db.get_server_by_id_or_none_async(session, server_id):
+        db.apply_server_update(server, server_update)
+        await session.commit()
+        await session.refresh(server)
+        return server
+    raise HTTPException(status.HTTP_404_NOT_FOUND, "Server not found")
+
+
+async def run(app, method, path, headers, body, concurrency) -> tuple[float, int]:
+    """Successful requests per second, and the number of failed requests."""
+    semaphore = asyncio.Semaphore(concurrency)
+    failures = 0
+
+    async def request():
+        nonlocal failures
+        async with semaphore:
+            try:
+                status_code = await utils.asgi_request(app, method, path, headers, body)
+            except Exception:
+                status_code = 500
+            failures += status_code != 200
+
+    start = time.perf_counter()
+    await asyncio.gather(*(request() for _ in range(requests_per_run)))
+    seconds = time.perf_counter() - start
+    return (requests_per_run - failures) / seconds, failures
+
+
+async def compare(routes):
+    # The async engine's connection pool belongs to a single event loop.
+    print(
+        f"{'route':>24} {'concurrency':>12} {'sync req/s':>11} {'failed':>7}"
+        f" {'async req/s':>12} {'failed':>7}"
+    )
+    for method, path, headers, body in routes:
+        for concurrency in concurrency_levels:
+            sync, sync_failed = await run(
+                sync_app, method, path, headers, body, concurrency
+            )
+            asynchronous, async_failed = await run(
+                async_app, method, path, headers, body, concurrency
+            )
+            print(
+                f"{path:>24} {concurrency:>12} {sync:>11.0f} {sync_failed:>7}"
+                f" {asynchronous:>12.0f} {async_failed:>7}"
+            )
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        utils.fresh_database(f"sqlite:///{Path(directory) / 'benchmark.db'}")
+        with Session(db.engine) as session:
+            (owner,) = utils.create_users(session, 1)
+            server_ids = [
+                utils.create_server(session, owner).id for _ in range(servers)
+            ]
+            for server_id in server_ids:
+                db.update_server(
+                    session,
+                    db.get_server_by_id(session, server_id),
+                    ServerUpdate(
+                        host_name="10.0.0.1",
+                        port=11235,
+                        display_name="Benchmark server",
+                        description="",
+                        game_type="RTSS",
+                        max_player_count=64,
+                        current_player_count=0,
+                        current_map="eden2",
+                    ),
+                )
+        token, _ = auth.generate_token("server", server_ids[0], config.server_token_ttl)
+        update = json.dumps(
+            dict(
+                host_name="10.0.0.1",
+                port=11235,
+                display_name="Benchmark server",
+                description="",
+                game_type="RTSS",
+                max_player_count=64,
+                current_player_count=12,
+                current_map="eden2",
+            )
+        ).encode()
+        routes = [
+            ("GET", "/v1/server/list/online", {}, b""),
+            (
+                "POST",
+                "/v1/server/update",
+                {
+                    "Authorization": f"Bearer {token}",
+                    "Content-Type": "application/json",
+                },
+                update,
+            ),
+        ]
+
+        asyncio.run(compare(routes))
+
+
+if __name__ == "__main__":
+    main()
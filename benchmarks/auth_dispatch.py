@@ -0,0 +1,71 @@
+"""Work done by `auth_user_or_server` for server-authenticated calls.
+
+Run with `python -m benchmarks.auth_dispatch`. Compares the current dispatch
+on credential shape with the old approach of trying the user path first and
+falling back to the server path. The credential cache and the failed-login
+throttle are cleared before every call, so each call is the cold case that
+pays for hashing."""
+
+from fastapi import HTTPException
+from fastapi.security import HTTPBasicCredentials
+from sqlmodel import Session
+
+from metaserver import auth
+from benchmarks import utils
+
+calls = 200
+
+
+def try_user_then_server(session, credentials):
+    try:
+        return auth.auth_user(session, credentials)
+    except HTTPException:
+        return auth.auth_server(session, credentials)
+
+
+def run(dependency, engine, credentials) -> utils.Counter:
+    hashes = 0
+    hash_password = auth.password_hasher.hash
+
+    def counting_hash(password, salt):
+        nonlocal hashes
+        hashes += 1
+        return hash_password(password, salt)
+
+    auth.password_hasher.hash = counting_hash
+    try:
+        with Session(engine) as session, utils.measure(engine) as counter:
+            for _ in range(calls):
+                auth.credential_cache.clear()
+                auth.login_throttle.clear()
+                dependency(session, credentials)
+                session.expunge_all()
+    finally:
+        del auth.password_hasher.hash
+    counter.hashes = hashes
+    return counter
+
+
+def main():
+    engine = utils.fresh_database()
+    with Session(engine) as session:
+        (owner,) = utils.create_users(session, 1)
+        server = utils.create_server(session, owner)
+        credentials = HTTPBasicCredentials(username=str(server.id), password="0" * 32)
+
+    print(
+        f"{'dispatch':>22} {'statements/call':>16} {'hashes/call':>12} {'ms/call':>8}"
+    )
+    for name, dependency in [
+        ("try user, then server", try_user_then_server),
+        ("credential shape", auth.auth_user_or_server),
+    ]:
+        counter = run(dependency, engine, credentials)
+        print(
+            f"{name:>22} {counter.statements / calls:>16.1f}"
+            f" {counter.hashes / calls:>12.1f} {1000 * counter.seconds / calls:>8.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
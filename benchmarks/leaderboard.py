@@ -0,0 +1,84 @@
+"""Rank lookups in SQL versus the in-memory leaderboard.
+
+Run with `python -m benchmarks.leaderboard`. Every server has `n` players
+with random ratings. SQL counts the better players with the (server_id,
+skill_rating) index, which still visits every one of them, while the
+leaderboard does a binary search. Also times loading a leaderboard and
+updating one rating."""
+
+import random
+import timeit
+
+from sqlalchemy import func, insert
+from sqlmodel import Session, col, select
+
+import metaserver.database.api as db
+from metaserver.database.models import UserStats
+from metaserver.leaderboard import Leaderboard
+from benchmarks import utils
+
+server_id = 1
+lookups = 200
+
+
+def main():
+    rng = random.Random(0)
+    print(
+        f"{'players':>8} {'sql rank µs':>12} {'board rank µs':>14}"
+        f" {'board update µs':>16} {'load ms':>8}"
+    )
+    for n in [1_000, 10_000, 100_000]:
+        engine = utils.fresh_database()
+        with Session(engine) as session:
+            session.execute(
+                insert(UserStats.__table__),
+                [
+                    dict(
+                        user_id=user_id,
+                        server_id=server_id,
+                        skill_rating=rng.uniform(400, 1600),
+                    )
+                    for user_id in range(1, n + 1)
+                ],
+            )
+            session.commit()
+            user_ids = [rng.randrange(1, n + 1) for _ in range(lookups)]
+            ratings = dict(db.get_skill_ratings(session, server_id))
+
+            def sql_rank(user_id):
+                return (
+                    1
+                    + session.exec(
+                        select(func.count()).where(
+                            UserStats.server_id == server_id,
+                            col(UserStats.skill_rating) > ratings[user_id],
+                        )
+                    ).one()
+                )
+
+            board = Leaderboard(db.get_skill_ratings(session, server_id))
+            for user_id in user_ids:
+                assert sql_rank(user_id) == board.rank(user_id).rank
+
+            sql, rank, update = [
+                timeit.timeit(lambda: [f(user_id) for user_id in user_ids], number=1)
+                / lookups
+                * 1e6
+                for f in [
+                    sql_rank,
+                    board.rank,
+                    lambda user_id: board.update(user_id, rng.uniform(400, 1600)),
+                ]
+            ]
+            load = (
+                timeit.timeit(
+                    lambda: Leaderboard(db.get_skill_ratings(session, server_id)),
+                    number=1,
+                )
+                * 1e3
+            )
+        print(f"{n:>8} {sql:>12.1f} {rank:>14.1f} {update:>16.1f} {load:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
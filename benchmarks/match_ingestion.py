@@ -0,0 +1,60 @@
+"""Statements and latency of ingesting match updates, one by one and as one
+batch.
+
+Run with `python -m benchmarks.match_ingestion`. Every match has 32 field
+players per team. The first match introduces all players, the others update
+their stats."""
+
+from sqlmodel import Session
+
+from metaserver import matches
+from metaserver.schemas import MatchUpdate
+from benchmarks import utils
+
+players_per_team = 32
+matches_per_run = 50
+
+
+def match_update(teams: int, winner: int) -> MatchUpdate:
+    return MatchUpdate(
+        teams=[
+            dict(
+                id=team_id,
+                race="human" if team_id % 2 else "beast",
+                field_players=[
+                    dict(user_id=team_id * players_per_team + i + 1)
+                    for i in range(players_per_team)
+                ],
+                commander=team_id * players_per_team + 1,
+            )
+            for team_id in range(teams)
+        ],
+        winner=winner,
+    )
+
+
+def main():
+    print(f"{'teams':>6} {'mode':>7} {'statements/match':>17} {'ms/match':>9}")
+    for teams in [2, 3, 4]:
+        updates = [
+            match_update(teams, i % (teams + 1) - 1) for i in range(matches_per_run)
+        ]
+        for mode in ["single", "batch"]:
+            engine = utils.fresh_database()
+            with Session(engine) as session:
+                (owner,) = utils.create_users(session, 1)
+                server_id = utils.create_server(session, owner).id
+            with Session(engine) as session, utils.measure(engine) as counter:
+                if mode == "single":
+                    for update in updates:
+                        matches.ingest_match(session, server_id, update)
+                else:
+                    matches.ingest_matches(session, server_id, updates)
+            print(
+                f"{teams:>6} {mode:>7} {counter.statements / matches_per_run:>17.2f}"
+                f" {1000 * counter.seconds / matches_per_run:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Login throughput versus the number of password hashing processes.
+
+Run with `python -m benchmarks.password_hashing`. Every simulated login is a
+cache miss, so each one costs a full PBKDF2 run on the hashing pool while the
+event loop stays free to serve other requests."""
+
+import asyncio
+import os
+import secrets
+import time
+
+from metaserver import auth
+
+logins = 256
+
+
+async def login_wave(hasher: auth.PasswordHasher, credentials: list[tuple[str, str]]):
+    await asyncio.gather(
+        *[hasher.hash_async(password, salt) for password, salt in credentials]
+    )
+
+
+def main():
+    credentials = [(secrets.token_hex(8), secrets.token_hex(8)) for _ in range(logins)]
+    print(f"{'workers':>8} {'logins/s':>10} {'speedup':>8}")
+    baseline = None
+    for workers in range(1, (os.cpu_count() or 1) + 1):
+        hasher = auth.PasswordHasher(workers=workers)
+        # Warm up so that process start-up isn't measured.
+        asyncio.run(login_wave(hasher, credentials[:workers]))
+        start = time.perf_counter()
+        asyncio.run(login_wave(hasher, credentials))
+        throughput = logins / (time.perf_counter() - start)
+        hasher.shutdown()
+        baseline = baseline or throughput
+        print(f"{workers:>8} {throughput:>10.1f} {throughput / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Scalar versus batch skill rating updates.
+
+Run with `python -m benchmarks.skill_ratings`. Times computing the new
+ratings of every field player in a match, per player with
+`metrics.skill_rating` and all at once with `metrics.skill_ratings`."""
+
+import random
+import timeit
+
+from metaserver import metrics
+
+repeats = 2000
+
+
+def main():
+    rng = random.Random(0)
+    print(f"{'players':>8} {'scalar µs':>10} {'batch µs':>9} {'speedup':>8}")
+    for teams, players_per_team in [(2, 8), (2, 32), (4, 32), (4, 256)]:
+        team_ids = [t for t in range(teams) for _ in range(players_per_team)]
+        ratings = [rng.uniform(400, 1600) for _ in team_ids]
+        assert metrics.skill_ratings(
+            ratings, team_ids, 0
+        ).tolist() == metrics.scalar_skill_ratings(ratings, team_ids, 0)
+        scalar, batch = [
+            min(
+                timeit.repeat(
+                    lambda: f(ratings, team_ids, 0), number=repeats // 10, repeat=10
+                )
+            )
+            / (repeats // 10)
+            * 1e6
+            for f in [metrics.scalar_skill_ratings, metrics.skill_ratings]
+        ]
+        print(
+            f"{len(team_ids):>8} {scalar:>10.1f} {batch:>9.1f} {scalar / batch:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Quality and latency of team balancing.
+
+Run with `python -m benchmarks.team_balancing`. Ratings are drawn from a
+normal distribution around the initial rating. Quality is the gap between
+the highest and lowest mean team rating of the greedy split alone, of the
+balanced split, and of the best of 1000 random splits. For two teams of up
+to 16 players, it's also compared with the best split overall."""
+
+from itertools import combinations
+import random
+import timeit
+
+import numpy as np
+
+from metaserver import config, teams
+
+repeats = 20
+random_splits = 1000
+
+
+def gap(ratings: list[float], members: list[list[int]]) -> float:
+    means = teams.mean_ratings(ratings, members)
+    return max(means) - min(means)
+
+
+def best_random_gap(rng: random.Random, ratings: list[float], k: int) -> float:
+    sizes = teams.team_sizes(len(ratings), k)
+    best = float("inf")
+    players = list(range(len(ratings)))
+    for _ in range(random_splits):
+        rng.shuffle(players)
+        ends = np.cumsum(sizes).tolist()
+        members = [players[end - size : end] for size, end in zip(sizes, ends)]
+        best = min(best, gap(ratings, members))
+    return best
+
+
+def optimal_gap(ratings: list[float]) -> float:
+    players = range(len(ratings))
+    return min(
+        gap(ratings, [list(team), [p for p in players if p not in team]])
+        for team in combinations(players, len(ratings) // 2)
+        if 0 in team
+    )
+
+
+def main():
+    rng = random.Random(0)
+    print(
+        f"{'players':>8} {'teams':>6} {'greedy gap':>11} {'balanced gap':>13}"
+        f" {'random gap':>11} {'optimal gap':>12} {'ms':>6}"
+    )
+    for players, k in [(16, 2), (32, 2), (64, 2), (32, 3), (64, 3), (64, 4)]:
+        ratings = [
+            rng.gauss(config.initial_user_skill_rating, 150) for _ in range(players)
+        ]
+        members = teams.balance_teams(ratings, k)
+        seconds = timeit.timeit(lambda: teams.balance_teams(ratings, k), number=repeats)
+        optimal = f"{optimal_gap(ratings):.3f}" if k == 2 and players <= 16 else "-"
+        print(
+            f"{players:>8} {k:>6}"
+            f" {gap(ratings, teams.deal(np.array(ratings), k)):>11.3f}"
+            f" {gap(ratings, members):>13.3f}"
+            f" {best_random_gap(rng, ratings, k):>11.3f}"
+            f" {optimal:>12}"
+            f" {1000 * seconds / repeats:>6.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
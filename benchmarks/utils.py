@@ -0,0 +1,113 @@
+import asyncio
+from contextlib import contextmanager
+from datetime import datetime
+import time
+
+from sqlalchemy import event
+from sqlmodel import Session, SQLModel
+
+from metaserver import auth
+import metaserver.database.api as db
+from metaserver.database.models import Server, User
+
+
+def fresh_database(database_url: str = "sqlite://"):
+    """Point the metaserver at an empty database, in memory by default like
+    the test suite does."""
+    db.engine, db.async_engine = db.create_engines(database_url)
+    SQLModel.metadata.create_all(db.engine)
+    return db.engine
+
+
+def create_users(session: Session, n: int, password: str = "12345678"):
+    key, salt = auth.hash_password(password, "salt"), "salt"
+    users = [
+        User(
+            username=f"user{i}@example.com",
+            display_name=f"user{i}",
+            key=key,
+            salt=salt,
+            verified_email=datetime.utcnow(),
+        )
+        for i in range(n)
+    ]
+    session.add_all(users)
+    session.commit()
+    return users
+
+
+def create_server(session: Session, user: User, password: str = "0" * 32):
+    server = Server(
+        key=auth.hash_password(password, "salt"),
+        salt="salt",
+        host_name="10.0.0.1",
+        port=11235,
+        display_name="Benchmark server",
+        description="",
+        game_type="RTSS",
+        max_player_count=64,
+        user=user,
+    )
+    session.add(server)
+    session.commit()
+    return server
+
+
+class Counter:
+    def __init__(self):
+        self.statements = 0
+        self.seconds = 0.0
+
+
+@contextmanager
+def measure(engine):
+    """Count the SQL statements executed on `engine` and the wall time spent
+    inside the block."""
+    counter = Counter()
+
+    def count(*args):
+        counter.statements += 1
+
+    event.listen(engine, "before_cursor_execute", count)
+    start = time.perf_counter()
+    try:
+        yield counter
+    finally:
+        counter.seconds = time.perf_counter() - start
+        event.remove(engine, "before_cursor_execute", count)
+
+
+async def asgi_request(
+    app, method: str, path: str, headers: dict[str, str] = {}, body: bytes = b""
+) -> int:
+    """Call an ASGI app directly, without a server or an HTTP client in
+    between. Returns the status code."""
+    scope = dict(
+        type="http",
+        asgi=dict(version="3.0"),
+        http_version="1.1",
+        method=method,
+        scheme="http",
+        path=path,
+        raw_path=path.encode(),
+        query_string=b"",
+        root_path="",
+        headers=[(k.lower().encode(), v.encode()) for k, v in headers.items()],
+        client=("127.0.0.1", 50000),
+        server=("testserver", 80),
+    )
+    messages = [dict(type="http.request", body=body, more_body=False)]
+    status_code = None
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        nonlocal status_code
+        if message["type"] == "http.response.start":
+            status_code = message["status"]
+
+    await app(scope, receive, send)
+    return status_code
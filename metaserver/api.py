@@ -1,26 +1,25 @@
 from datetime import datetime
 import base64
-from itertools import chain
 import json
 import secrets
 
 from fastapi import (
-    BackgroundTasks,
     Body,
     Depends,
     FastAPI,
+    Header,
     HTTPException,
     Query,
     Response,
     status,
 )
 from fastapi.responses import RedirectResponse
-from pydantic import Field, ValidationError
+from pydantic import Field, ValidationError, conlist
 from sqlalchemy.exc import IntegrityError
 from sqlmodel import Session
 
 import metaserver.database.api as db
-from metaserver import auth, config, email
+from metaserver import auth, config, email, keys, leaderboard, teams
 from metaserver.database.models import (
     Clan,
     EmailToken,
@@ -31,21 +30,30 @@ from metaserver.database.models import (
     Server,
 )
 from metaserver.database.utils import UserClanLinkDeletedReason, UserClanLinkRank
-from metaserver import metrics
+from metaserver import matches
 from metaserver.schemas import (
     ClanCreate,
     ClanUpdateIcon,
+    LeaderboardEntry,
+    MatchQueueItemRead,
     MatchUpdate,
     ServerLogin,
     ServerCreate,
     ServerRead,
+    ServerToken,
     ServerUpdate,
     Team,
+    TeamBalance,
+    TeamBalanceRequest,
+    UserAggregateStatsRead,
     UserClanLinkUpdateRank,
     UserCreate,
     UserLogin,
+    UserProof,
     UserRead,
     UserReadWithProof,
+    UserReadWithSession,
+    UserStatsColumns,
 )
 
 app = FastAPI()
@@ -55,6 +63,20 @@ app = FastAPI()
 def on_startup():
     if config.dev_mode:
         db.dev_mode_startup()
+    db.last_online_buffer.start()
+    matches.match_queue_worker.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    auth.password_hasher.shutdown()
+    matches.match_queue_worker.stop()
+    db.last_online_buffer.stop()
+
+
+@app.on_event("shutdown")
+async def on_shutdown_async():
+    await db.async_engine.dispose()
 
 
 @app.get("/")
@@ -63,6 +85,36 @@ def index():
     return "OK"
 
 
+@app.get("/.well-known/user-proof-keys.json", tags=["user"])
+def user_proof_keys():
+    """Public keys for verifying signed user proofs, as a JSON Web Key Set.
+    Game servers can cache these and verify signed proofs without asking the
+    metaserver. Look up keys by the `kid` in the proof, and fetch the set again
+    when a proof has a `kid` you haven't seen yet."""
+    return keys.proof_signing_keys.jwks()
+
+
+@app.get(
+    "/v1/metaserver/stats",
+    response_model=dict[str, dict],
+    tags=["metaserver"],
+    dependencies=[Depends(auth.auth_operator)],
+)
+def metaserver_stats():
+    """Counters of the caches, throttles, buffers and pools of the worker
+    process that serves the request, for whoever runs the metaserver. Send
+    `STATS_TOKEN` as a bearer token. Without it set, this route doesn't
+    exist."""
+    return dict(
+        credential_cache=auth.credential_cache.stats(),
+        login_throttle=auth.login_throttle.stats(),
+        last_online_buffer=db.last_online_buffer.stats(),
+        database_pools=db.pool_stats(),
+        match_queue=matches.match_queue_worker.stats(),
+        leaderboards=leaderboard.leaderboards.stats(),
+    )
+
+
 ############
 # /v1/user #
 ############
@@ -72,7 +124,7 @@ def index():
 def user(
     user_id: int = Query(),
     *,
-    user: UserLogin = Depends(auth.auth_user),
+    _: int = Depends(auth.auth_user_id),
     session: Session = Depends(db.get_session),
 ):
     if user := db.get_user_by_id(session, user_id):
@@ -84,7 +136,7 @@ def user(
 def user_by_id_batch(
     user_ids: list[int] = Query(),
     *,
-    user: UserLogin = Depends(auth.auth_user),
+    _: int = Depends(auth.auth_user_id),
     session: Session = Depends(db.get_session),
 ):
     return db.get_users_by_id(session, user_ids)
@@ -96,13 +148,13 @@ def user_clan_invites(
     user: UserLogin = Depends(auth.auth_user),
     session: Session = Depends(db.get_session),
 ):
-    return [link for link in user.clan_links if link.is_open_invitation]
+    return db.get_user_clan_invites(session, user.id)
 
 
-@app.post("/v1/user/login", response_model=UserReadWithProof, tags=["user"])
+@app.post("/v1/user/login", response_model=UserReadWithSession, tags=["user"])
 def user_login(
     *,
-    user: UserLogin = Depends(auth.auth_user),
+    user: UserLogin = Depends(auth.auth_login_user_async),
     session: Session = Depends(db.get_session),
 ):
     """Verify user credentials and obtain a user proof token. The user provides
@@ -111,32 +163,56 @@ def user_login(
     using the `/v1/user/verify-user-proof` route.
 
     Because the implementation is cryptographic there's no need to store tokens
-    in the database, but all user proof tokens are invalidated together
-    periodically and whenever the server secret involved is refreshed. It is
-    unlikely that user numbers are ever going to get so crazy that the wave of
-    requests to this route after a token invalidation event overwhelms the
-    server, but if this happens the system should be expanded so that each user
-    should receive their own TTL token."""
+    in the database. Every proof carries its own expiry, with some random
+    jitter on top of `config.user_proof_ttl`, so re-logins are spread out
+    instead of arriving in a wave. All proofs are also invalidated whenever the
+    server secret involved is refreshed.
+
+    The signed proof in the response can be verified by the third party
+    itself, using the public keys at `/.well-known/user-proof-keys.json`.
+
+    The response also holds a session token. Send it as `Authorization: Bearer
+    <token>` instead of the username and password to skip the password check
+    on subsequent requests. This route itself only takes the username and
+    password, so the session ends when the token expires."""
     db.set_user_last_online_now(session, user)
     user_proof = auth.generate_user_proof(user.id)
-    return UserReadWithProof(**user.dict(), proof=user_proof)
+    session_token, session_token_expires = auth.generate_token(
+        "user", user.id, config.session_token_ttl
+    )
+    return UserReadWithSession(
+        **user.dict(),
+        proof=user_proof,
+        signed_proof=auth.generate_signed_user_proof(user.id),
+        session_token=session_token,
+        session_token_expires=session_token_expires,
+    )
 
 
 @app.post("/v1/user/verify-user-proof", response_model=bool, tags=["user"])
 def user_verify_user_proof(
     user_id: int = Body(embed=True),
     user_proof: str = Body(embed=True),
-    *,
-    background_tasks: BackgroundTasks,
-    session: Session = Depends(db.get_session),
 ):
     """Verify user proof. See docstring for user login for more."""
     if auth.verify_user_proof(user_id, user_proof):
-        background_tasks.add_task(db.set_user_last_online_now_by_id, session, user_id)
+        db.set_user_last_online_now_by_id(user_id)
         return True
     return False
 
 
+@app.post("/v1/user/verify-user-proof/batch", response_model=list[bool], tags=["user"])
+def user_verify_user_proof_batch(
+    proofs: conlist(item_type=UserProof, min_items=1, max_items=128) = Body(embed=True),
+):
+    """Verify many user proofs at once, for instance for all players on a
+    server after a map change. Results are in the same order as the proofs."""
+    results = [auth.verify_user_proof(p.user_id, p.user_proof) for p in proofs]
+    if verified := [p.user_id for p, ok in zip(proofs, results) if ok]:
+        db.set_users_last_online_now_by_id(verified)
+    return results
+
+
 @app.post("/v1/user/register", response_model=UserReadWithProof, tags=["user"])
 def user_register(
     new_user: UserCreate,
@@ -161,7 +237,11 @@ def user_register(
             raise HTTPException(status.HTTP_409_CONFLICT, "Display name taken")
         else:
             raise HTTPException(status.HTTP_409_CONFLICT, "Username taken")
-    return UserReadWithProof(**user.dict(), proof=auth.generate_user_proof(user.id))
+    return UserReadWithProof(
+        **user.dict(),
+        proof=auth.generate_user_proof(user.id),
+        signed_proof=auth.generate_signed_user_proof(user.id),
+    )
 
 
 @app.post("/v1/user/verify-clan-membership", response_model=bool, tags=["user"])
@@ -180,7 +260,6 @@ def user_verify_clan_membership(
 def user_email_verify(
     mail_token: str = Body(embed=True, min_length=6, max_length=6),
     *,
-    background_tasks: BackgroundTasks,
     session: Session = Depends(db.get_session),
     user: UserLogin = Depends(auth.auth_unverified_user),
 ):
@@ -191,9 +270,11 @@ def user_email_verify(
         if secrets.compare_digest(mail_token, token.key):
             user.verified_email = datetime.utcnow()
             db.commit_and_refresh(session, user)
-            background_tasks.add_task(db.set_user_last_online_now, session, user)
+            db.set_user_last_online_now(session, user)
             return UserReadWithProof(
-                **user.dict(), proof=auth.generate_user_proof(user.id)
+                **user.dict(),
+                proof=auth.generate_user_proof(user.id),
+                signed_proof=auth.generate_signed_user_proof(user.id),
             )
         else:
             raise HTTPException(
@@ -250,15 +331,53 @@ def get_user_stats(
     raise HTTPException(status.HTTP_404_NOT_FOUND)
 
 
-@app.get("/v1/user/stats/batch", response_model=list[UserStats], tags=["user"])
-def get_user_stats(
-    user_ids: int = Query(),
-    server_id: int = Query(),
+@app.get("/v1/user/stats/batch", response_model=UserStatsColumns, tags=["user"])
+def get_user_stats_batch(
+    user_ids: list[int] = Query(max_items=config.user_stats_batch_max_size),
+    server_ids: list[int] = Query(max_items=config.user_stats_batch_max_size),
     *,
     session: Session = Depends(db.get_session),
     _: UserLogin | ServerLogin = Depends(auth.auth_user_or_server),
 ):
-    return db.get_user_stats_batch(session, user_id, server_id)
+    """Stats of every user in `user_ids` on every server in `server_ids`, for
+    example for a scoreboard. Pass each id as a separate parameter, like
+    `?user_ids=1&user_ids=2&server_ids=3`. Users that have never played on a
+    server have no entry for it."""
+    return UserStatsColumns.from_rows(
+        db.get_user_stats_rows(session, user_ids, server_ids)
+    )
+
+
+@app.get(
+    "/v1/user/stats/aggregate",
+    response_model=UserAggregateStatsRead,
+    tags=["user"],
+)
+def get_user_aggregate_stats(
+    user_id: int = Query(),
+    *,
+    session: Session = Depends(db.get_session),
+    _: UserLogin | ServerLogin = Depends(auth.auth_user_or_server),
+):
+    """A user's stats summed over all servers, with their mean skill rating."""
+    if aggregate_stats := db.get_user_aggregate_stats(session, user_id):
+        return aggregate_stats
+    raise HTTPException(status.HTTP_404_NOT_FOUND)
+
+
+@app.get(
+    "/v1/user/stats/aggregate/batch",
+    response_model=list[UserAggregateStatsRead],
+    tags=["user"],
+)
+def get_user_aggregate_stats_batch(
+    user_ids: list[int] = Query(max_items=config.user_stats_batch_max_size),
+    *,
+    session: Session = Depends(db.get_session),
+    _: UserLogin | ServerLogin = Depends(auth.auth_user_or_server),
+):
+    """Users that have never played are left out."""
+    return db.get_user_aggregate_stats_batch(session, user_ids)
 
 
 ############
@@ -270,7 +389,7 @@ def get_user_stats(
 def clan(
     *,
     session: Session = Depends(db.get_session),
-    user: UserLogin = Depends(auth.auth_user),
+    _: int = Depends(auth.auth_user_id),
 ):
     return db.get_all_clans(session)
 
@@ -316,10 +435,9 @@ def clan_for_user_by_id(
     session: Session = Depends(db.get_session),
     user: UserLogin = Depends(auth.auth_user),
 ):
-    if user_id != user.id:
-        if not (user := db.get_user_by_id(session, user_id)):
-            raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
-    return [link for link in user.clan_links if link.is_membership]
+    if user_id != user.id and not db.get_user_by_id(session, user_id):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "User not found")
+    return db.get_user_clan_memberships(session, user_id)
 
 
 @app.post("/v1/clan/invite", tags=["clan"])
@@ -462,10 +580,9 @@ def clan_members(
     clan_id: int,
     *,
     session: Session = Depends(db.get_session),
-    user: UserLogin = Depends(auth.auth_user),
+    _: int = Depends(auth.auth_user_id),
 ):
-    clan = db.get_clan_by_id(session, clan_id)
-    return [link for link in clan.user_links if link.is_membership]
+    return db.get_clan_members(session, clan_id)
 
 
 @app.post("/v1/clan/register", response_model=Clan, tags=["clan"])
@@ -548,7 +665,7 @@ def skin_for_user_by_id(
     clan_id: int | None = Query(None),
     *,
     session: Session = Depends(db.get_session),
-    user: UserLogin = Depends(auth.auth_user),
+    _: int = Depends(auth.auth_user_id),
 ):
     skins = db.get_skins_for_user_by_id(session, user_id)
     if clan_id:
@@ -561,11 +678,69 @@ def skin_for_clan_by_id(
     clan_id: int,
     *,
     session: Session = Depends(db.get_session),
-    user: UserLogin = Depends(auth.auth_user),
+    _: int = Depends(auth.auth_user_id),
 ):
     return db.get_skins_for_clan_by_id(session, clan_id)
 
 
+###################
+# /v1/leaderboard #
+###################
+
+
+@app.get(
+    "/v1/leaderboard/top",
+    response_model=list[LeaderboardEntry],
+    tags=["leaderboard"],
+)
+def leaderboard_top(
+    server_id: int = Query(),
+    n: int = Query(default=10, ge=1, le=config.leaderboard_max_entries),
+    *,
+    session: Session = Depends(db.get_session),
+    _: UserLogin | ServerLogin = Depends(auth.auth_user_or_server),
+):
+    """The best `n` players on the server."""
+    return leaderboard.leaderboards.get(session, server_id).top(n)
+
+
+@app.get(
+    "/v1/leaderboard/rank",
+    response_model=LeaderboardEntry,
+    tags=["leaderboard"],
+)
+def leaderboard_rank(
+    server_id: int = Query(),
+    user_id: int = Query(),
+    *,
+    session: Session = Depends(db.get_session),
+    _: UserLogin | ServerLogin = Depends(auth.auth_user_or_server),
+):
+    if entry := leaderboard.leaderboards.get(session, server_id).rank(user_id):
+        return entry
+    raise HTTPException(status.HTTP_404_NOT_FOUND, "User has no rank on this server")
+
+
+@app.get(
+    "/v1/leaderboard/around",
+    response_model=list[LeaderboardEntry],
+    tags=["leaderboard"],
+)
+def leaderboard_around(
+    server_id: int = Query(),
+    user_id: int = Query(),
+    n: int = Query(default=5, ge=0, le=config.leaderboard_max_entries // 2),
+    *,
+    session: Session = Depends(db.get_session),
+    _: UserLogin | ServerLogin = Depends(auth.auth_user_or_server),
+):
+    """The user with up to `n` players ranked above and below them."""
+    board = leaderboard.leaderboards.get(session, server_id)
+    if (entries := board.around(user_id, n)) is not None:
+        return entries
+    raise HTTPException(status.HTTP_404_NOT_FOUND, "User has no rank on this server")
+
+
 ##############
 # /v1/server #
 ##############
@@ -598,6 +773,16 @@ def server_register(
         raise HTTPException(status.HTTP_422_UNPROCESSABLE_ENTITY)
 
 
+@app.post("/v1/server/login", response_model=ServerToken, tags=["server"])
+def server_login(*, server: ServerLogin = Depends(auth.auth_login_server_async)):
+    """Exchange the server username and password for a signed token. Game
+    servers send this as a bearer token with their periodic updates, which
+    saves the metaserver a database lookup and a password hash per update.
+    New tokens are only handed out for the username and password."""
+    token, expires = auth.generate_token("server", server.id, config.server_token_ttl)
+    return ServerToken(token=token, expires=expires)
+
+
 @app.get("/v1/server/list/my", response_model=list[ServerRead], tags=["server"])
 def server_list_my(
     *,
@@ -620,9 +805,11 @@ def server_update(
     server_update: ServerUpdate,
     *,
     session: Session = Depends(db.get_session),
-    server: ServerLogin = Depends(auth.auth_server),
+    server_id: int = Depends(auth.auth_server_id),
 ):
-    return db.update_server(session, server, server_update)
+    if server := db.get_server_by_id_or_none(session, server_id):
+        return db.update_server(session, server, server_update)
+    raise HTTPException(status.HTTP_404_NOT_FOUND, "Server not found")
 
 
 @app.post("/v1/server/verify-clan-membership", response_model=bool, tags=["server"])
@@ -631,7 +818,7 @@ def server_verify_clan_membership(
     clan_id: int = Body(embed=True),
     *,
     session: Session = Depends(db.get_session),
-    server: ServerLogin = Depends(auth.auth_server),
+    _: int = Depends(auth.auth_server_id),
 ):
     if link := db.get_user_clan_link(session, user_id, clan_id):
         return link.is_membership
@@ -643,69 +830,95 @@ def server_match_update(
     match_update: MatchUpdate,
     *,
     session: Session = Depends(db.get_session),
-    server: ServerLogin = Depends(auth.auth_server),
+    server_id: int = Depends(auth.auth_server_id),
 ):
     """Post a match update to update stats per player for this server. The
-    match update data itself is not stored (yet)."""
-    user_stats_per_team = {
-        team.id: db.get_user_stats_batch(
-            session,
-            [fp.user_id for fp in team.field_players],
-            server.id,
-        )
-        for team in match_update.teams
-    }
-
-    for team_id, users_stats in user_stats_per_team.items():
-        new_users = [
-            set([us.user_id for us in team.field_players])
-            for team in match_update.teams
-            if team.id == team_id
-        ][0] - set([us.user_id for us in users_stats])
-        for user_id in new_users:
-            new_stats = UserStats(user_id=user_id, server_id=server.id)
-            user_stats_per_team[team_id].append(new_stats)
-
-    mean_rating_per_team = {
-        team_id: metrics.mean_skill_rating(us)
-        for team_id, us in user_stats_per_team.items()
-    }
-    for team_id, user_stats in user_stats_per_team.items():
-        for us in user_stats:
-            us.skill_rating = metrics.skill_rating(
-                current_rating=us.skill_rating,
-                mean_team_rating=mean_rating_per_team[team_id],
-                mean_opponent_rating=(
-                    mean_rating_per_team[match_update.winner]
-                    if match_update.winner != -1
-                    else sum(
-                        [m for tid, m in mean_rating_per_team.items() if tid != team_id]
-                    )
-                    / (len(match_update.teams) - 1)
-                ),
-                achieved_score=(
-                    (team_id == match_update.winner)
-                    if match_update.winner != -1
-                    else 0.5
-                ),
-            )
-            us.last_seen = datetime.utcnow()
-            us.matches_played_field += 1
-            if team_id == match_update.winner:
-                us.matches_won_field += 1
-        # Game server may use 0 or < 0 for unregistered users.
-        db.commit_and_refresh_batch(
-            session, [us for us in user_stats if us.user_id > 0]
-        )
+    match is added to the server's match history, from which ratings can be
+    recomputed."""
+    matches.ingest_match(session, server_id, match_update)
 
-    to_commit = list(chain(*user_stats_per_team.values()))
-    for team in match_update.teams:
-        if comm_stats := db.get_user_stats(
-            session, user_id=team.commander, server_id=server.id
-        ):
-            comm_stats.matches_played_command += 1
-            if team.id == match_update.winner:
-                comm_stats.matches_won_command += 1
-            to_commit.append(comm_stats)
-
-    db.commit_and_refresh_batch(session, [us for us in to_commit if us.user_id > 0])
+
+@app.post("/v1/server/match-update/batch", tags=["server"])
+def server_match_update_batch(
+    match_updates: conlist(
+        item_type=MatchUpdate, max_items=config.match_update_batch_max_size
+    ) = Body(),
+    *,
+    session: Session = Depends(db.get_session),
+    server_id: int = Depends(auth.auth_server_id),
+):
+    """Post match updates that were buffered, for example while the
+    metaserver was unreachable. They are applied in the order given, in a
+    single transaction, with the same result as posting them one by one to
+    `/v1/server/match-update`."""
+    matches.ingest_matches(session, server_id, match_updates)
+
+
+@app.post("/v1/server/balance-teams", response_model=TeamBalance, tags=["server"])
+def server_balance_teams(
+    team_balance_request: TeamBalanceRequest,
+    *,
+    session: Session = Depends(db.get_session),
+    _: UserLogin | ServerLogin = Depends(auth.auth_user_or_server),
+):
+    """Split players into teams with mean skill ratings on the server that are
+    as close as possible. Players that haven't played on the server count
+    with the initial skill rating."""
+    user_ids = team_balance_request.user_ids
+    known = dict(
+        db.get_skill_ratings(session, team_balance_request.server_id, user_ids)
+    )
+    # Ratings on the server mean that it exists, so it's only looked up when
+    # there are none.
+    if not known and not db.get_server_by_id_or_none(
+        session, team_balance_request.server_id
+    ):
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Server not found")
+    ratings = [
+        known.get(user_id, config.initial_user_skill_rating) for user_id in user_ids
+    ]
+    members = teams.balance_teams(ratings, team_balance_request.teams)
+    mean_ratings = teams.mean_ratings(ratings, members)
+    return TeamBalance(
+        teams=[[user_ids[player] for player in team] for team in members],
+        mean_skill_ratings=mean_ratings,
+        skill_rating_gap=max(mean_ratings) - min(mean_ratings),
+    )
+
+
+@app.post(
+    "/v1/server/match-update/queue",
+    response_model=MatchQueueItemRead,
+    status_code=status.HTTP_202_ACCEPTED,
+    tags=["server"],
+)
+def server_match_update_queue(
+    match_update: MatchUpdate,
+    *,
+    idempotency_key: str | None = Header(default=None, max_length=255),
+    session: Session = Depends(db.get_session),
+    server_id: int = Depends(auth.auth_server_id),
+):
+    """Like `/v1/server/match-update`, but only validates and stores the match
+    update, and responds right away. Stats are updated in the background.
+    Retrying with the same `Idempotency-Key` header returns the original item
+    instead of queueing the match again."""
+    return matches.enqueue_match(session, server_id, match_update, idempotency_key)
+
+
+@app.get(
+    "/v1/server/match-update/queue/by-id",
+    response_model=MatchQueueItemRead,
+    tags=["server"],
+)
+def server_match_update_queue_by_id(
+    item_id: int,
+    *,
+    session: Session = Depends(db.get_session),
+    server_id: int = Depends(auth.auth_server_id),
+):
+    """A match update is ingested once `processed` is set, unless there is
+    an `error`."""
+    if item := db.get_match_queue_item(session, server_id, item_id):
+        return item
+    raise HTTPException(status.HTTP_404_NOT_FOUND, "Queued match update not found")
@@ -1,20 +1,38 @@
+import asyncio
+import base64
+import binascii
+from concurrent.futures import ProcessPoolExecutor
 import hashlib
+import hmac
+import math
+import multiprocessing
 import os
+import random
 import secrets
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timedelta
 from typing import Optional
 
-from fastapi import Depends, HTTPException, status
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from cachetools import TTLCache
+from fastapi import Depends, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security import (
+    HTTPAuthorizationCredentials,
+    HTTPBasic,
+    HTTPBasicCredentials,
+    HTTPBearer,
+)
 from pydantic import SecretStr
 from sqlmodel import Session
-from sqlalchemy.exc import NoResultFound
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 import metaserver.database.api as db
-from metaserver import config, constants
+from metaserver import config, keys
 from metaserver.database.models import Server, User
 
-security = HTTPBasic()
+basic = HTTPBasic(auto_error=False)
+bearer = HTTPBearer(auto_error=False)
 
 
 def hash_password(password: str, salt: str) -> str:
@@ -26,100 +44,593 @@ def hash_password(password: str, salt: str) -> str:
     ).hex()
 
 
+class PasswordHasher:
+    """Runs `hash_password` on a dedicated process pool, so that a wave of
+    logins uses every core instead of filling up the request threadpool. With
+    zero workers, hashing happens on the calling thread."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.pool: ProcessPoolExecutor | None = None
+        self.lock = threading.Lock()
+
+    def executor(self) -> ProcessPoolExecutor | None:
+        if self.workers and self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                    )
+        return self.pool
+
+    def hash(self, password: str, salt: str) -> str:
+        if pool := self.executor():
+            return pool.submit(hash_password, password, salt).result()
+        return hash_password(password, salt)
+
+    async def hash_async(self, password: str, salt: str) -> str:
+        if pool := self.executor():
+            return await asyncio.get_running_loop().run_in_executor(
+                pool, hash_password, password, salt
+            )
+        return await run_in_threadpool(hash_password, password, salt)
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+
+password_hasher = PasswordHasher(workers=config.password_hash_workers)
+
+
 def new_password(password: SecretStr):
     salt = secrets.token_hex(8)
-    key = hash_password(password.get_secret_value(), salt)
+    key = password_hasher.hash(password.get_secret_value(), salt)
     return key, salt
 
 
+class CredentialCache:
+    """Remembers credentials that recently passed a password check.
+
+    Entries are keyed on an HMAC of the supplied credentials together with the
+    stored salt and key, under a secret that never leaves the process. A
+    password change produces a new salt and key, so stale entries can't match
+    anymore. The cache only vouches for the password: `deleted` and
+    `verified_email` are still checked against the database row on every
+    request, so changes to those take effect immediately."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.secret = secrets.token_bytes(32)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def digest(self, kind: str, username: str, password: str, salt: str, key: str):
+        return hmac.digest(
+            self.secret,
+            "\0".join([kind, username, password, salt, key]).encode("utf-8"),
+            "sha256",
+        )
+
+    def lookup(self, digest: bytes) -> bool:
+        with self.lock:
+            if self.cache.get(digest):
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def remember(self, digest: bytes):
+        with self.lock:
+            self.cache[digest] = True
+
+    def cached(self, kind: str, username: str, password: str, salt: str, key: str):
+        return self.lookup(self.digest(kind, username, password, salt, key))
+
+    def verify(
+        self, kind: str, username: str, password: str, salt: str, key: str
+    ) -> bool:
+        """Hashes the password without looking in the cache first, and
+        remembers it if it's right."""
+        if secrets.compare_digest(password_hasher.hash(password, salt), key):
+            self.remember(self.digest(kind, username, password, salt, key))
+            return True
+        return False
+
+    async def verify_async(
+        self, kind: str, username: str, password: str, salt: str, key: str
+    ) -> bool:
+        if secrets.compare_digest(
+            await password_hasher.hash_async(password, salt), key
+        ):
+            self.remember(self.digest(kind, username, password, salt, key))
+            return True
+        return False
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, size=len(self.cache))
+
+
+credential_cache = CredentialCache(
+    maxsize=config.credential_cache_maxsize,
+    ttl=config.credential_cache_ttl.total_seconds(),
+)
+
+
+class ClientBasicCredentials(HTTPBasicCredentials):
+    """Basic credentials plus the address they were sent from."""
+
+    client: str | None
+
+
+class LoginThrottle:
+    """Token buckets for failed password checks, one per username and one per
+    client address. Every failure takes a token from both buckets, and tokens
+    trickle back at a fixed rate. When either bucket is empty, attempts are
+    rejected before they cost a password hash. Credentials in the credential
+    cache never reach the throttle, so failures sent in someone's name can't
+    lock out clients that already logged in.
+
+    A full bucket is the same as no bucket, so buckets are dropped once they
+    would have refilled completely, and the least recently used ones are
+    evicted when there are too many."""
+
+    def __init__(self, capacity: int, refill_per_second: float, maxsize: int):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.buckets = TTLCache(maxsize=maxsize, ttl=capacity / refill_per_second)
+        self.lock = threading.Lock()
+        self.rejected_by_username = 0
+        self.rejected_by_client = 0
+
+    def keys(self, credentials: HTTPBasicCredentials) -> tuple[str, str | None]:
+        client = getattr(credentials, "client", None)
+        return f"username:{credentials.username}", client and f"client:{client}"
+
+    def tokens(self, key: str, now: float) -> float:
+        tokens, updated = self.buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.refill_per_second)
+
+    def allow(self, credentials: HTTPBasicCredentials) -> bool:
+        username_key, client_key = self.keys(credentials)
+        now = time.monotonic()
+        with self.lock:
+            if self.tokens(username_key, now) < 1:
+                self.rejected_by_username += 1
+                return False
+            if client_key and self.tokens(client_key, now) < 1:
+                self.rejected_by_client += 1
+                return False
+        return True
+
+    def fail(self, credentials: HTTPBasicCredentials):
+        now = time.monotonic()
+        with self.lock:
+            for key in self.keys(credentials):
+                if key:
+                    self.buckets[key] = (self.tokens(key, now) - 1, now)
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+            self.rejected_by_username = 0
+            self.rejected_by_client = 0
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            rejected_by_username=self.rejected_by_username,
+            rejected_by_client=self.rejected_by_client,
+            buckets=len(self.buckets),
+        )
+
+
+login_throttle = LoginThrottle(
+    capacity=config.failed_login_burst,
+    refill_per_second=1 / config.failed_login_refill_interval.total_seconds(),
+    maxsize=config.failed_login_throttle_maxsize,
+)
+
+
+class DeletedServers:
+    """The ids of deleted servers, loaded again once they are older than
+    `reload_interval`. Lets routes that only check the signature of a server
+    token turn away deleted servers without a database lookup per request."""
+
+    def __init__(self, reload_interval: float):
+        self.reload_interval = reload_interval
+        self.ids: frozenset[int] = frozenset()
+        self.loaded = -math.inf
+
+    async def contains_async(self, session: AsyncSession, server_id: int) -> bool:
+        if time.monotonic() - self.loaded > self.reload_interval:
+            self.ids = frozenset(await db.get_deleted_server_ids_async(session))
+            self.loaded = time.monotonic()
+        return server_id in self.ids
+
+    def clear(self):
+        self.ids = frozenset()
+        self.loaded = -math.inf
+
+
+deleted_servers = DeletedServers(
+    reload_interval=config.deleted_servers_reload_interval.total_seconds()
+)
+
+
+def unauthorized(detail: str = "Incorrect username or password") -> HTTPException:
+    return HTTPException(
+        status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Basic"},
+    )
+
+
+def ensure_user_is_active(user: User) -> User:
+    if not user.verified_email:
+        raise unauthorized("User email is unverified")
+    if user.deleted:
+        raise unauthorized("User is deleted")
+    return user
+
+
+def ensure_server_is_active(server: Server) -> Server:
+    if server.deleted:
+        raise unauthorized("Server is deleted")
+    return server
+
+
+def throttled() -> HTTPException:
+    return HTTPException(
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many failed login attempts, try again later",
+        headers={"Retry-After": str(math.ceil(1 / login_throttle.refill_per_second))},
+    )
+
+
+def client_address(request: Request) -> str | None:
+    """The address of the client, as seen by the trusted proxy in front of us
+    if `config.trusted_forwarded_header` is set. That proxy appends the
+    address it saw to the header, so earlier entries are up to the client."""
+    if config.trusted_forwarded_header:
+        if forwarded := request.headers.get(config.trusted_forwarded_header):
+            return forwarded.rsplit(",", 1)[-1].strip() or None
+    return request.client.host if request.client else None
+
+
+def check_login(
+    kind: str, credentials: HTTPBasicCredentials, account: User | Server | None
+) -> bool:
+    """Checks the password of `account`, or fails if there's no such account.
+    Only password checks that miss the credential cache are throttled."""
+    args = (kind, credentials.username, credentials.password)
+    if account and credential_cache.cached(*args, account.salt, account.key):
+        return True
+    if not login_throttle.allow(credentials):
+        raise throttled()
+    if account and credential_cache.verify(*args, account.salt, account.key):
+        return True
+    login_throttle.fail(credentials)
+    return False
+
+
+async def check_login_async(
+    kind: str, credentials: HTTPBasicCredentials, account: User | Server | None
+) -> bool:
+    args = (kind, credentials.username, credentials.password)
+    if account and credential_cache.cached(*args, account.salt, account.key):
+        return True
+    if not login_throttle.allow(credentials):
+        raise throttled()
+    if account and await credential_cache.verify_async(
+        *args, account.salt, account.key
+    ):
+        return True
+    login_throttle.fail(credentials)
+    return False
+
+
+def auth_operator(
+    credentials: HTTPAuthorizationCredentials | None = Depends(bearer),
+):
+    """For routes that are only meant for whoever runs the metaserver, who
+    sends `config.stats_token` as a bearer token."""
+    if not config.stats_token:
+        raise HTTPException(status.HTTP_404_NOT_FOUND)
+    if credentials is None or not secrets.compare_digest(
+        credentials.credentials.encode("utf-8"), config.stats_token.encode("utf-8")
+    ):
+        raise HTTPException(
+            status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid stats token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+
+def get_credentials(
+    request: Request,
+    basic_credentials: HTTPBasicCredentials | None = Depends(basic),
+    bearer_credentials: HTTPAuthorizationCredentials | None = Depends(bearer),
+) -> HTTPBasicCredentials | HTTPAuthorizationCredentials:
+    """Either a username and password, or a bearer token issued by this
+    server."""
+    if basic_credentials:
+        return ClientBasicCredentials(
+            **basic_credentials.dict(),
+            client=client_address(request),
+        )
+    if bearer_credentials:
+        return bearer_credentials
+    raise unauthorized("Not authenticated")
+
+
+def get_basic_credentials(
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
+) -> HTTPBasicCredentials:
+    if isinstance(credentials, HTTPBasicCredentials):
+        return credentials
+    raise unauthorized()
+
+
+def token_subject(kind: str, token: HTTPAuthorizationCredentials) -> int:
+    if subject := verify_token(kind, token.credentials):
+        return subject
+    raise unauthorized("Invalid or expired token")
+
+
+def is_server_credentials(
+    credentials: HTTPBasicCredentials | HTTPAuthorizationCredentials,
+) -> bool:
+    """Users log in with their email address and servers with their numeric
+    id, so the kind of principal follows from the credentials alone."""
+    if isinstance(credentials, HTTPAuthorizationCredentials):
+        return credentials.credentials.startswith("server.")
+    return credentials.username.isascii() and credentials.username.isdigit()
+
+
 def auth_user_or_server(
     session: Session = Depends(db.get_session),
-    credentials: HTTPBasicCredentials = Depends(security),
-):
-    try:
-        return auth_user(session, credentials)
-    except HTTPException:
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
+) -> User | Server:
+    if is_server_credentials(credentials):
         return auth_server(session, credentials)
+    return auth_user(session, credentials)
 
 
 def auth_user(
     session: Session = Depends(db.get_session),
-    credentials: HTTPBasicCredentials = Depends(security),
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
 ) -> User:
-    if user := db.get_user_by_username(session, credentials.username):
-        supplied_key = hash_password(credentials.password, user.salt)
-        if secrets.compare_digest(supplied_key, user.key):
-            if not user.verified_email:
-                raise HTTPException(
-                    status.HTTP_401_UNAUTHORIZED,
-                    detail="User email is unverified",
-                    headers={"WWW-Authenticate": "Basic"},
-                )
-            if user.deleted:
-                raise HTTPException(
-                    status.HTTP_401_UNAUTHORIZED,
-                    detail="User is deleted",
-                    headers={"WWW-Authenticate": "Basic"},
-                )
-            return user
-    raise HTTPException(
-        status.HTTP_401_UNAUTHORIZED,
-        detail="Incorrect username or password",
-        headers={"WWW-Authenticate": "Basic"},
-    )
+    if isinstance(credentials, HTTPAuthorizationCredentials):
+        if user := session.get(User, token_subject("user", credentials)):
+            return ensure_user_is_active(user)
+        raise unauthorized()
+    return ensure_user_is_active(auth_unverified_user(session, credentials))
+
+
+def auth_user_id(
+    session: Session = Depends(db.get_session),
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
+) -> int:
+    """For routes that only need to know who is calling. Session tokens are
+    checked with a single HMAC and no database lookup, so a user that is
+    deleted keeps access to these routes until their token expires."""
+    if isinstance(credentials, HTTPAuthorizationCredentials):
+        return token_subject("user", credentials)
+    return auth_user(session, credentials).id
 
 
 def auth_unverified_user(
     session: Session = Depends(db.get_session),
-    credentials: HTTPBasicCredentials = Depends(security),
+    credentials: HTTPBasicCredentials = Depends(get_basic_credentials),
 ) -> User:
-    try:
-        user = db.get_user_by_username(session, credentials.username)
-        supplied_key = hash_password(credentials.password, user.salt)
-        if secrets.compare_digest(supplied_key, user.key):
-            return user
-    except NoResultFound:
-        pass
-    raise HTTPException(
-        status.HTTP_401_UNAUTHORIZED,
-        detail="Incorrect username or password",
-        headers={"WWW-Authenticate": "Basic"},
-    )
+    user = db.get_user_by_username(session, credentials.username)
+    if check_login("user", credentials, user):
+        return user
+    raise unauthorized()
 
 
 def auth_server(
     session: Session = Depends(db.get_session),
-    credentials: HTTPBasicCredentials = Depends(security),
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
+) -> Server:
+    if isinstance(credentials, HTTPAuthorizationCredentials):
+        if server := session.get(Server, token_subject("server", credentials)):
+            return ensure_server_is_active(server)
+        raise unauthorized()
+    server = db.get_server_by_id_or_none(session, credentials.username)
+    if check_login("server", credentials, server):
+        return ensure_server_is_active(server)
+    raise unauthorized()
+
+
+# Async variants of the dependencies above. Database lookups go to the
+# threadpool and hashing goes to the process pool, so the event loop is never
+# blocked while a login is being checked.
+
+
+async def auth_user_async(
+    session: Session = Depends(db.get_session),
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
+) -> User:
+    if isinstance(credentials, HTTPAuthorizationCredentials):
+        user_id = token_subject("user", credentials)
+        if user := await run_in_threadpool(session.get, User, user_id):
+            return ensure_user_is_active(user)
+        raise unauthorized()
+    return ensure_user_is_active(await auth_unverified_user_async(session, credentials))
+
+
+async def auth_unverified_user_async(
+    session: Session = Depends(db.get_session),
+    credentials: HTTPBasicCredentials = Depends(get_basic_credentials),
+) -> User:
+    user = await run_in_threadpool(
+        db.get_user_by_username, session, credentials.username
+    )
+    if await check_login_async("user", credentials, user):
+        return user
+    raise unauthorized()
+
+
+async def auth_server_async(
+    session: AsyncSession = Depends(db.get_async_session),
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
+) -> Server:
+    if isinstance(credentials, HTTPAuthorizationCredentials):
+        server_id = token_subject("server", credentials)
+        if server := await session.get(Server, server_id):
+            return ensure_server_is_active(server)
+        raise unauthorized()
+    server = await db.get_server_by_id_or_none_async(session, credentials.username)
+    if await check_login_async("server", credentials, server):
+        return ensure_server_is_active(server)
+    raise unauthorized()
+
+
+# The login routes hand out bearer tokens, so they only take a username and
+# password. Otherwise a token could be renewed with itself forever, and would
+# outlive a password change or a stolen token's expiry.
+
+
+async def auth_login_user_async(
+    session: Session = Depends(db.get_session),
+    credentials: HTTPBasicCredentials = Depends(get_basic_credentials),
+) -> User:
+    return ensure_user_is_active(await auth_unverified_user_async(session, credentials))
+
+
+async def auth_login_server_async(
+    session: AsyncSession = Depends(db.get_async_session),
+    credentials: HTTPBasicCredentials = Depends(get_basic_credentials),
 ) -> Server:
+    return await auth_server_async(session, credentials)
+
+
+async def auth_server_id(
+    session: AsyncSession = Depends(db.get_async_session),
+    credentials: HTTPBasicCredentials
+    | HTTPAuthorizationCredentials = Depends(get_credentials),
+) -> int:
+    """For routes that only need to know which server is calling. Server
+    tokens are checked with a single HMAC and against `deleted_servers`, so a
+    server that is deleted keeps access to these routes for up to
+    `config.deleted_servers_reload_interval`."""
+    if isinstance(credentials, HTTPAuthorizationCredentials):
+        server_id = token_subject("server", credentials)
+        if await deleted_servers.contains_async(session, server_id):
+            raise unauthorized("Server is deleted")
+        return server_id
+    return (await auth_server_async(session, credentials)).id
+
+
+def generate_token(kind: str, subject: int, ttl: timedelta) -> tuple[str, datetime]:
+    """Sign a short-lived bearer token of the form
+    `<kind>.<subject>.<expiry timestamp>.<kid>.<signature>`."""
+    expires = int(time.time() + ttl.total_seconds())
+    kid, secret = keys.token_keys.active()
+    payload = f"{kind}.{subject}.{expires}.{kid}"
+    return f"{payload}.{sign(secret, payload)}", datetime.utcfromtimestamp(expires)
+
+
+def verify_token(kind: str, token: str) -> int | None:
+    """Returns the subject of the token if it is valid, unexpired and of the
+    right kind. Costs one HMAC."""
+    payload, _, signature = token.rpartition(".")
     try:
-        server = db.get_server_by_id(session, credentials.username)
-        supplied_key = hash_password(credentials.password, server.salt)
-        if secrets.compare_digest(supplied_key, server.key):
-            return server
-    except NoResultFound:
+        token_kind, subject, expires, kid = payload.split(".")
+        if (
+            token_kind == kind
+            and int(expires) > time.time()
+            and (secret := keys.token_keys.get(kid))
+            and secrets.compare_digest(
+                signature.encode("utf-8"), sign(secret, payload).encode("utf-8")
+            )
+        ):
+            return int(subject)
+    except ValueError:
         pass
-    raise HTTPException(
-        status.HTTP_401_UNAUTHORIZED,
-        detail="Incorrect username or password",
-        headers={"WWW-Authenticate": "Basic"},
-    )
+    return None
+
+
+def sign(secret: str, payload: str) -> str:
+    signature = hmac.digest(secret.encode("utf-8"), payload.encode("utf-8"), "sha256")
+    return base64.urlsafe_b64encode(signature).decode("utf-8").rstrip("=")
+
+
+def user_proof_expiry() -> int:
+    """Proofs expire individually, with some random jitter, so that a wave of
+    logins doesn't turn into a wave of re-logins one TTL later."""
+    jitter = random.uniform(0, config.user_proof_ttl_jitter.total_seconds())
+    return int(time.time() + config.user_proof_ttl.total_seconds() + jitter)
 
 
 def generate_user_proof(user_id: int) -> str:
-    return hashlib.sha256(
-        (
-            # Proofs are specific to users.
-            str(user_id)
-            # Only the server can generate proofs and proofs invalidate on restart.
-            + constants.secret_for_user_proof
-            # Proofs invalidate periodically.
-            + datetime.utcnow().strftime(config.proof_datetime_component_format)
-        ).encode("utf-8")
-    ).hexdigest()
+    """The format is `<kid>.<expiry timestamp>.<signature>`, where the
+    signature is an HMAC over the user id and the expiry timestamp. Only the
+    metaserver can generate and verify these."""
+    expires = user_proof_expiry()
+    kid, secret = keys.user_proof_keys.active()
+    return f"{kid}.{expires}.{sign(secret, f'{user_id}.{expires}')}"
+
+
+def generate_signed_user_proof(user_id: int) -> str:
+    """Like `generate_user_proof`, but signed with Ed25519 so that anyone with
+    the published public keys can verify it. The format is
+    `<kid>.<user id>.<expiry timestamp>.<signature>`, where the signature is
+    over everything before the last dot."""
+    kid, key = keys.proof_signing_keys.signing_key()
+    payload = f"{kid}.{user_id}.{user_proof_expiry()}"
+    return f"{payload}.{keys.b64encode(key.sign(payload.encode('utf-8')))}"
+
+
+def verify_signed_user_proof(user_id: int, user_proof: str) -> bool:
+    payload, _, signature = user_proof.rpartition(".")
+    try:
+        kid, proof_user_id, expires = payload.split(".")
+        return (
+            int(proof_user_id) == user_id
+            and int(expires) > time.time()
+            and keys.proof_signing_keys.verify(
+                kid, payload.encode("utf-8"), keys.b64decode(signature)
+            )
+        )
+    except (ValueError, binascii.Error):
+        return False
 
 
 def verify_user_proof(user_id: int, user_proof: str) -> bool:
-    return secrets.compare_digest(user_proof, generate_user_proof(user_id))
+    """Accepts any unexpired proof in either format."""
+    if user_proof.count(".") == 3:
+        return verify_signed_user_proof(user_id, user_proof)
+    try:
+        kid, expires, signature = user_proof.split(".")
+        return bool(
+            int(expires) > time.time()
+            and (secret := keys.user_proof_keys.get(kid))
+            and secrets.compare_digest(
+                signature.encode("utf-8"),
+                sign(secret, f"{user_id}.{expires}").encode("utf-8"),
+            )
+        )
+    except ValueError:
+        return False
 
 
 def generate_server_password() -> SecretStr:
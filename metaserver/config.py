@@ -6,11 +6,106 @@ server_online_cutoff = timedelta(minutes=1)
 database_url = os.environ.get("DATABASE_URL", "sqlite://")
 dev_mode = True if os.environ.get("DEV") else False
 
+# Connections kept open per engine, and how many more may be opened under load.
+# Requests wait up to the pool timeout for a connection beyond that.
+database_pool_size = int(os.environ.get("DATABASE_POOL_SIZE", 10))
+database_max_overflow = int(os.environ.get("DATABASE_MAX_OVERFLOW", 20))
+database_pool_timeout = timedelta(seconds=30)
+
+# Page cache of all SQLite connections together, in KiB. Every connection has
+# its own cache, so it is split evenly over the most connections that the
+# synchronous and the asyncio engine can have open, but never below SQLite's
+# default of 2000 KiB. The memory-mapped database file is shared by all of
+# them on top of that.
+sqlite_cache_budget = int(os.environ.get("SQLITE_CACHE_BUDGET", 256 * 1024))
+sqlite_connection_cache_size = max(
+    2000, sqlite_cache_budget // (2 * (database_pool_size + database_max_overflow))
+)
+
+# Applied to every new connection to an SQLite database file. In WAL mode
+# readers don't block the writer and vice versa. With synchronous=NORMAL,
+# commits don't wait for the disk; a power loss can undo the last few commits
+# but never corrupts the database. Writers wait up to busy_timeout milliseconds
+# for each other instead of failing with "database is locked". Negative
+# cache sizes are in KiB.
+sqlite_pragmas = dict(
+    journal_mode="WAL",
+    synchronous="NORMAL",
+    busy_timeout=5000,
+    mmap_size=256 * 1024 * 1024,
+    cache_size=-sqlite_connection_cache_size,
+)
+
+# The longest a user's last online timestamp can go unwritten to the database.
+last_online_flush_interval = timedelta(seconds=10)
+
 # How long people have to wait between receiving an email token and requesting a new one.
 email_token_renew_timeout = timedelta(seconds=30)
 
-# The granularity of this format determines how long a proof is valid
-proof_datetime_component_format = "%Y-%m-%dT%H:%M"
+# Largest number of users whose stats can be requested at once.
+user_stats_batch_max_size = 256
+
+# Largest number of match updates accepted by one batch request.
+match_update_batch_max_size = 1000
+
+# Queued match updates are ingested in batches of this size. The worker wakes
+# up when a match is queued, and otherwise checks the queue every poll interval.
+match_queue_batch_size = 100
+match_queue_poll_interval = timedelta(seconds=10)
+# Queued matches that fail to ingest for reasons other than the match update
+# itself, like a locked or unreachable database, are tried again on the next
+# poll, up to this many times.
+match_queue_max_attempts = 5
+
+# How long a user proof is valid. Each proof gets up to `user_proof_ttl_jitter`
+# on top, so that proofs handed out at the same time don't expire together.
+user_proof_ttl = timedelta(minutes=1)
+user_proof_ttl_jitter = timedelta(seconds=30)
+
+# The secrets that sign user proofs and tokens live in the database, so that all
+# workers share them. They are replaced every `secret_key_rotation_interval`.
+# Previous keys are kept until everything they signed has expired.
+secret_key_rotation_interval = timedelta(days=1)
+# How often workers check the database for keys added by other workers.
+secret_key_reload_interval = timedelta(seconds=30)
+
+# How long the session token handed out on login can be used instead of a
+# username and password.
+session_token_ttl = timedelta(minutes=15)
+
+# Same, for game servers. These post updates at least every
+# `server_online_cutoff`, so their tokens can live a bit longer.
+server_token_ttl = timedelta(hours=1)
+
+# Routes that only check the signature of server tokens learn about deleted
+# servers this often.
+deleted_servers_reload_interval = timedelta(seconds=30)
+
+# Successful password checks are remembered for this long, so clients that send
+# the same credentials with every request only pay for hashing once.
+credential_cache_ttl = timedelta(minutes=5)
+credential_cache_maxsize = 10_000
+
+# Failed password checks per username and per client address. After a burst of
+# failures, one more attempt is allowed every refill interval. Attempts beyond
+# that are rejected before they cost a password hash, unless the credentials
+# are in the credential cache.
+failed_login_burst = 10
+failed_login_refill_interval = timedelta(seconds=6)
+failed_login_throttle_maxsize = 100_000
+
+# Header that the reverse proxy in front of the metaserver puts the client
+# address in, such as X-Forwarded-For. Without it, every client behind the
+# proxy shares its address. Only set this when clients can't reach the
+# metaserver without going through the proxy, or they can pick any address.
+trusted_forwarded_header = os.environ.get("TRUSTED_FORWARDED_HEADER")
+
+# Bearer token for `/v1/metaserver/stats`, which is disabled without one.
+stats_token = os.environ.get("STATS_TOKEN")
+
+# Number of processes that hash passwords. With 0, hashing happens on the
+# request thread.
+password_hash_workers = int(os.environ.get("PASSWORD_HASH_WORKERS", 0))
 
 #######################
 # Skill rating config #
@@ -24,3 +119,9 @@ initial_user_skill_rating = 800
 lambda_ = 0.8
 
 skill_rating_update_step_size = 64
+
+# Leaderboards are kept in memory per server and updated with every match this
+# process ingests. They are reloaded from the database after this long, to pick
+# up matches ingested by other workers and recomputed ratings.
+leaderboard_ttl = timedelta(minutes=1)
+leaderboard_max_entries = 100
@@ -1,5 +1 @@
-import secrets
-
-secret_for_user_proof = secrets.token_hex()
-
 disposable_email_domains_url = "https://raw.githubusercontent.com/disposable-email-domains/disposable-email-domains/master/disposable_email_blocklist.conf"
@@ -3,13 +3,33 @@ import random
 import string
 from typing import Literal, Optional
 
-from sqlmodel import VARCHAR, Column, Field, JSON, Relationship, SQLModel, create_engine
+from sqlalchemy import Index, UniqueConstraint, and_
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlmodel import (
+    VARCHAR,
+    Column,
+    Field,
+    JSON,
+    Relationship,
+    SQLModel,
+    col,
+    create_engine,
+)
 
 from metaserver import config
 from metaserver.database.utils import UserClanLinkDeletedReason, UserClanLinkRank
 
 
 class UserClanLink(SQLModel, table=True):
+    """The states of a link are hybrid properties, so they can be used both on
+    loaded links and in queries, like `select(UserClanLink).where(
+    UserClanLink.is_membership)`."""
+
+    __table_args__ = (
+        Index("ix_userclanlink_clan_id_state", "clan_id", "joined", "deleted"),
+        Index("ix_userclanlink_user_id_state", "user_id", "joined", "deleted"),
+    )
+
     clan_id: int | None = Field(default=None, foreign_key="clan.id", primary_key=True)
     user_id: int | None = Field(default=None, foreign_key="user.id", primary_key=True)
 
@@ -22,39 +42,74 @@ class UserClanLink(SQLModel, table=True):
     deleted: datetime | None
     deleted_reason: UserClanLinkDeletedReason | None
 
-    @property
+    class Config:
+        keep_untouched = (hybrid_property,)
+
+    @hybrid_property
     def is_membership(self):
         return bool(self.joined and not self.deleted)
 
-    @property
+    @is_membership.expression
+    def is_membership(cls):
+        return and_(col(cls.joined).is_not(None), col(cls.deleted).is_(None))
+
+    @hybrid_property
     def is_declined_invitation(self):
         return bool(
             not self.joined
             and self.deleted
-            and self.deleted_reason is UserClanLinkDeletedReason.DECLINED
+            and self.deleted_reason == UserClanLinkDeletedReason.DECLINED
         )
 
-    @property
+    @is_declined_invitation.expression
+    def is_declined_invitation(cls):
+        return and_(
+            col(cls.joined).is_(None),
+            col(cls.deleted).is_not(None),
+            cls.deleted_reason == UserClanLinkDeletedReason.DECLINED,
+        )
+
+    @hybrid_property
     def is_open_invitation(self):
         return not (self.joined or self.deleted)
 
-    @property
+    @is_open_invitation.expression
+    def is_open_invitation(cls):
+        return and_(col(cls.joined).is_(None), col(cls.deleted).is_(None))
+
+    @hybrid_property
     def is_retracted_invitation(self):
         return bool(
             not self.joined
             and self.deleted
-            and self.deleted_reason is UserClanLinkDeletedReason.RETRACTED
+            and self.deleted_reason == UserClanLinkDeletedReason.RETRACTED
         )
 
-    @property
+    @is_retracted_invitation.expression
+    def is_retracted_invitation(cls):
+        return and_(
+            col(cls.joined).is_(None),
+            col(cls.deleted).is_not(None),
+            cls.deleted_reason == UserClanLinkDeletedReason.RETRACTED,
+        )
+
+    @hybrid_property
     def user_left_clan(self):
         return bool(
             self.joined
             and self.deleted
-            and self.deleted_reason is UserClanLinkDeletedReason.LEFT
+            and self.deleted_reason == UserClanLinkDeletedReason.LEFT
         )
 
-    @property
+    @user_left_clan.expression
+    def user_left_clan(cls):
+        return and_(
+            col(cls.joined).is_not(None),
+            col(cls.deleted).is_not(None),
+            cls.deleted_reason == UserClanLinkDeletedReason.LEFT,
+        )
+
+    @hybrid_property
     def user_was_kicked(self):
         return bool(
             self.joined
@@ -62,6 +117,14 @@ class UserClanLink(SQLModel, table=True):
             and self.deleted_reason == UserClanLinkDeletedReason.KICKED
         )
 
+    @user_was_kicked.expression
+    def user_was_kicked(cls):
+        return and_(
+            col(cls.joined).is_not(None),
+            col(cls.deleted).is_not(None),
+            cls.deleted_reason == UserClanLinkDeletedReason.KICKED,
+        )
+
 
 class ClanSkinLink(SQLModel, table=True):
     skin_id: int | None = Field(default=None, foreign_key="skin.id", primary_key=True)
@@ -82,6 +145,10 @@ class UserSkinLink(SQLModel, table=True):
 class UserStats(SQLModel, table=True):
     """Maintains running stats per user per server."""
 
+    __table_args__ = (
+        Index("ix_userstats_server_id_skill_rating", "server_id", "skill_rating"),
+    )
+
     user_id: int | None = Field(default=None, foreign_key="user.id", primary_key=True)
     server_id: int | None = Field(
         default=None, foreign_key="server.id", primary_key=True
@@ -99,6 +166,29 @@ class UserStats(SQLModel, table=True):
     skill_rating: int = config.initial_user_skill_rating
 
 
+class UserAggregateStats(SQLModel, table=True):
+    """Running stats per user, summed over all servers. These are updated in
+    the same transaction as `UserStats`, by adding the changes of every
+    ingest, so they never have to be summed at read time."""
+
+    user_id: int | None = Field(default=None, foreign_key="user.id", primary_key=True)
+
+    last_seen: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    servers_played: int = 0
+    matches_played_field: int = 0
+    matches_played_command: int = 0
+    matches_won_field: int = 0
+    matches_won_command: int = 0
+    skill_rating_sum: float = 0
+
+    @property
+    def mean_skill_rating(self) -> float:
+        """Over the servers the user has stats on."""
+        if not self.servers_played:
+            return config.initial_user_skill_rating
+        return self.skill_rating_sum / self.servers_played
+
+
 class User(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     username: str = Field(
@@ -164,7 +254,6 @@ class Server(SQLModel, table=True):
     deleted: datetime | None
     deleted_reason: str | None
 
-    # matches: list["Match"] = Relationship(back_populates="server")
     user_id: int = Field(default=None, foreign_key="user.id")
     user: User = Relationship(back_populates="servers")
     user_stats: list[UserStats] = Relationship(back_populates="server")
@@ -186,23 +275,45 @@ class EmailToken(SQLModel, table=True):
         return "".join(random.choice(chars) for i in range(key_length))
 
 
+class SecretKey(SQLModel, table=True):
+    """Secrets shared by all API workers. See `metaserver.keys`."""
+
+    id: str = Field(primary_key=True)
+    purpose: str = Field(index=True)
+    secret: str
+    created: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+
+
 #########
 # Match #
 #########
 
 
-# class Match(SQLModel, table=True):
-#     id: Optional[int] = Field(default=None, primary_key=True)
-#     server_id: int = Field(default=None, foreign_key="server.id")
-#     server: "Server" = Relationship(back_populates="matches")
-#     updates: list[MatchUpdate]
-#     started: datetime
-#     ended: Optional[datetime]
+class MatchQueueItem(SQLModel, table=True):
+    """A match update that was accepted for ingestion. Items are kept after
+    they are processed, so that retries with the same idempotency key keep
+    finding them."""
+
+    __table_args__ = (UniqueConstraint("server_id", "idempotency_key"),)
 
+    id: int | None = Field(default=None, primary_key=True)
+    server_id: int = Field(foreign_key="server.id")
+    idempotency_key: str | None
+    match_update: dict = Field(sa_column=Column(JSON, nullable=False))
+    received: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    processed: datetime | None = Field(default=None, index=True)
+    error: str | None
+    # Attempts that failed for reasons other than the match update itself.
+    attempts: int = 0
 
-# class MatchUpdate(SQLModel, table=True):
-#     id: Optional[int] = Field(default=None, primary_key=True)
-#     data: dict = Field(sa_column=Column(JSON))
 
-#     class Config:
-#         arbitrary_types_allowed = True
+class Match(SQLModel, table=True):
+    """The result of a match as it was ingested, so that ratings can be
+    recomputed from history. Teams are stored compactly, with field players
+    as a list of user ids. See `metaserver.matches.compact_teams`."""
+
+    id: int | None = Field(default=None, primary_key=True)
+    server_id: int = Field(foreign_key="server.id", index=True)
+    ingested: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    teams: list = Field(sa_column=Column(JSON, nullable=False))
+    winner: int
@@ -0,0 +1,188 @@
+import base64
+from datetime import datetime, timedelta
+import secrets
+import threading
+import time
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    NoEncryption,
+    PrivateFormat,
+    PublicFormat,
+)
+from sqlmodel import Session
+
+from metaserver import config
+import metaserver.database.api as db
+from metaserver.database.models import SecretKey
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("utf-8").rstrip("=")
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class KeyStore:
+    """Secrets for one purpose, shared by all API workers through the database.
+
+    The newest key is active and is used to sign. Previous keys are kept until
+    everything they signed has expired: that is `signed_ttl` after they were
+    replaced, plus `reload_interval` for workers that kept signing with them
+    until they noticed. Every key has a short id (`kid`) that is embedded in
+    whatever it signs, so the verifier knows which key to use. Whichever
+    worker first notices that the active key is older than the rotation
+    interval adds a new one, unless the database shows another worker just
+    did. Workers reload the keys periodically, and immediately when they come
+    across a `kid` they don't know yet."""
+
+    def __init__(
+        self,
+        purpose: str,
+        rotation_interval: float,
+        signed_ttl: float,
+        reload_interval: float,
+    ):
+        self.purpose = purpose
+        self.rotation_interval = rotation_interval
+        self.signed_ttl = signed_ttl
+        self.reload_interval = reload_interval
+        # Oldest first, so the last item is the active key.
+        self.keys: dict[str, SecretKey] = {}
+        self.loaded: float = 0
+        self.lock = threading.RLock()
+
+    def new_secret(self) -> str:
+        return secrets.token_hex(32)
+
+    def reload(self):
+        with self.lock, Session(db.engine) as session:
+            self.keys = {
+                key.id: key for key in db.get_secret_keys(session, self.purpose)
+            }
+            self.loaded = time.time()
+
+    def rotate(self, if_older_than: float | None = None):
+        """Adds a new active key. With `if_older_than`, only if the newest key
+        in the database is older than that many seconds, since our own keys
+        may be stale."""
+        with self.lock, Session(db.engine) as session:
+            newest = db.get_newest_secret_key(session, self.purpose)
+            if (
+                if_older_than is None
+                or newest is None
+                or (datetime.utcnow() - newest.created).total_seconds() > if_older_than
+            ):
+                db.add_secret_key(
+                    session,
+                    SecretKey(
+                        id=secrets.token_hex(4),
+                        purpose=self.purpose,
+                        secret=self.new_secret(),
+                    ),
+                )
+            db.delete_retired_secret_keys(
+                session,
+                self.purpose,
+                retired_before=datetime.utcnow()
+                - timedelta(seconds=self.signed_ttl + self.reload_interval),
+            )
+            self.reload()
+
+    def active(self) -> tuple[str, str]:
+        with self.lock:
+            if time.time() - self.loaded > self.reload_interval:
+                self.reload()
+            if not self.keys or (
+                (
+                    datetime.utcnow() - next(reversed(self.keys.values())).created
+                ).total_seconds()
+                > self.rotation_interval
+            ):
+                self.rotate(if_older_than=self.rotation_interval)
+            key = next(reversed(self.keys.values()))
+            return key.id, key.secret
+
+    def get(self, kid: str) -> str | None:
+        with self.lock:
+            if kid not in self.keys and time.time() - self.loaded > 1:
+                # Probably signed by another worker after a rotation.
+                self.reload()
+            if key := self.keys.get(kid):
+                return key.secret
+            return None
+
+    def kids(self) -> list[str]:
+        """Newest first."""
+        self.active()
+        return list(reversed(self.keys))
+
+
+class ProofSigningKeys(KeyStore):
+    """Ed25519 keys that sign user proofs, stored as raw private key bytes."""
+
+    def new_secret(self) -> str:
+        return (
+            Ed25519PrivateKey.generate()
+            .private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+            .hex()
+        )
+
+    def private_key(self, secret: str) -> Ed25519PrivateKey:
+        return Ed25519PrivateKey.from_private_bytes(bytes.fromhex(secret))
+
+    def signing_key(self) -> tuple[str, Ed25519PrivateKey]:
+        kid, secret = self.active()
+        return kid, self.private_key(secret)
+
+    def verify(self, kid: str, data: bytes, signature: bytes) -> bool:
+        if not (secret := self.get(kid)):
+            return False
+        try:
+            self.private_key(secret).public_key().verify(signature, data)
+            return True
+        except InvalidSignature:
+            return False
+
+    def jwks(self) -> dict:
+        """The public keys as a JSON Web Key Set (RFC 7517, RFC 8037)."""
+        return {
+            "keys": [
+                {
+                    "kty": "OKP",
+                    "crv": "Ed25519",
+                    "alg": "EdDSA",
+                    "use": "sig",
+                    "kid": kid,
+                    "x": b64encode(
+                        self.private_key(self.get(kid))
+                        .public_key()
+                        .public_bytes(Encoding.Raw, PublicFormat.Raw)
+                    ),
+                }
+                for kid in self.kids()
+            ]
+        }
+
+
+def key_store_kwargs(signed_ttl: timedelta) -> dict:
+    return dict(
+        rotation_interval=config.secret_key_rotation_interval.total_seconds(),
+        signed_ttl=signed_ttl.total_seconds(),
+        reload_interval=config.secret_key_reload_interval.total_seconds(),
+    )
+
+
+user_proof_ttl = config.user_proof_ttl + config.user_proof_ttl_jitter
+user_proof_keys = KeyStore("user-proof", **key_store_kwargs(user_proof_ttl))
+token_keys = KeyStore(
+    "token",
+    **key_store_kwargs(max(config.session_token_ttl, config.server_token_ttl)),
+)
+proof_signing_keys = ProofSigningKeys(
+    "user-proof-signing", **key_store_kwargs(user_proof_ttl)
+)
@@ -0,0 +1,117 @@
+import threading
+import time
+from typing import Iterable
+
+from sortedcontainers import SortedList
+from sqlmodel import Session
+
+import metaserver.database.api as db
+from metaserver import config
+from metaserver.database.models import UserStats
+from metaserver.schemas import LeaderboardEntry
+
+
+class Leaderboard:
+    """The skill ratings of one server, as an order statistic structure.
+
+    Ratings are kept in a sorted list of `(-skill_rating, user_id)` keys, best
+    first, so ranks and positions are found with a binary search instead of by
+    counting rows. The list is split into short sublists with an index on top,
+    so updating a rating moves one key in logarithmic time instead of shifting
+    the whole list."""
+
+    def __init__(self, ratings: Iterable[tuple[int, float]]):
+        self.ratings = dict(ratings)
+        # Nearly free when the ratings come in sorted, as from the database.
+        self.keys = SortedList(
+            (-rating, user_id) for user_id, rating in self.ratings.items()
+        )
+        self.loaded = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def update(self, user_id: int, rating: float):
+        with self.lock:
+            if (old_rating := self.ratings.get(user_id)) is not None:
+                self.keys.remove((-old_rating, user_id))
+            self.ratings[user_id] = rating
+            self.keys.add((-rating, user_id))
+
+    def entry(self, index: int) -> LeaderboardEntry:
+        negative_rating, user_id = self.keys[index]
+        return LeaderboardEntry(
+            # The first key with this rating, since (x,) sorts before (x, y).
+            rank=self.keys.bisect_left((negative_rating,)) + 1,
+            user_id=user_id,
+            skill_rating=-negative_rating,
+        )
+
+    def top(self, n: int) -> list[LeaderboardEntry]:
+        with self.lock:
+            return [self.entry(i) for i in range(min(n, len(self.keys)))]
+
+    def rank(self, user_id: int) -> LeaderboardEntry | None:
+        with self.lock:
+            if (rating := self.ratings.get(user_id)) is None:
+                return None
+            return self.entry(self.keys.index((-rating, user_id)))
+
+    def around(self, user_id: int, n: int) -> list[LeaderboardEntry] | None:
+        """The user with up to `n` players above and below them."""
+        with self.lock:
+            if (rating := self.ratings.get(user_id)) is None:
+                return None
+            index = self.keys.index((-rating, user_id))
+            return [
+                self.entry(i)
+                for i in range(max(0, index - n), min(index + n + 1, len(self.keys)))
+            ]
+
+
+class Leaderboards:
+    """Loads the leaderboard of a server when it is first asked for, and keeps
+    it up to date with the matches that this process ingests. Leaderboards
+    are loaded again once they are older than `ttl`."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.boards: dict[int, Leaderboard] = {}
+        self.lock = threading.Lock()
+        self.loads = 0
+
+    def get(self, session: Session, server_id: int) -> Leaderboard:
+        with self.lock:
+            board = self.boards.get(server_id)
+        if board is None or time.monotonic() - board.loaded > self.ttl:
+            board = Leaderboard(db.get_skill_ratings(session, server_id))
+            with self.lock:
+                self.boards[server_id] = board
+                self.loads += 1
+        return board
+
+    def update(self, server_id: int, stats: Iterable[UserStats]):
+        """Leaderboards that aren't loaded yet will see the new ratings when
+        they are."""
+        with self.lock:
+            board = self.boards.get(server_id)
+        if board is not None:
+            for us in stats:
+                board.update(us.user_id, us.skill_rating)
+
+    def clear(self):
+        with self.lock:
+            self.boards.clear()
+            self.loads = 0
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return dict(
+                loads=self.loads,
+                servers=len(self.boards),
+                users=sum(len(board) for board in self.boards.values()),
+            )
+
+
+leaderboards = Leaderboards(ttl=config.leaderboard_ttl.total_seconds())
@@ -0,0 +1,341 @@
+from datetime import datetime
+from itertools import chain
+import json
+import logging
+import threading
+
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session
+
+import metaserver.database.api as db
+from metaserver import config, leaderboard, metrics
+from metaserver.database.models import (
+    Match,
+    MatchQueueItem,
+    UserAggregateStats,
+    UserStats,
+)
+from metaserver.schemas import MatchUpdate
+
+
+def ingest_match(session: Session, server_id: int, match_update: MatchUpdate):
+    """Updates the stats of every field player and commander in the match.
+    However large the match, this takes one read of all stats involved and
+    a bulk write per table, in a single transaction."""
+    ingest_matches(session, server_id, [match_update])
+
+
+def ingest_matches(session: Session, server_id: int, match_updates: list[MatchUpdate]):
+    """Applies the match updates in order, as if they were ingested one by
+    one, and adds them to the match history. The stats of all players in all
+    matches are read once, carried from match to match in memory, and written
+    in one bulk upsert, as are the changes to their aggregate stats.
+
+    Concurrent ingests wait for each other from before the read until the
+    commit, since each one writes back whole rows computed from what it
+    read."""
+    user_ids = set()
+    for match_update in match_updates:
+        for team in match_update.teams:
+            user_ids.add(team.commander)
+            user_ids.update(fp.user_id for fp in team.field_players)
+    db.lock_user_stats(session)
+    stats = {
+        us.user_id: us
+        for us in db.get_user_stats_batch(session, list(user_ids), server_id)
+    }
+    before = {
+        user_id: {name: getattr(us, name) for name in summed_stats}
+        for user_id, us in stats.items()
+    }
+    replay(stats, server_id, match_updates)
+    db.add_matches(
+        session,
+        [
+            Match(
+                server_id=server_id,
+                teams=compact_teams(match_update),
+                winner=match_update.winner,
+            )
+            for match_update in match_updates
+        ],
+    )
+    db.execute_upsert(session, list(stats.values()))
+    db.execute_upsert(
+        session,
+        [
+            aggregate_stats_change(before.get(user_id), us)
+            for user_id, us in stats.items()
+        ],
+        increment=("servers_played", "skill_rating_sum", *summed_stats[:-1]),
+    )
+    session.commit()
+    leaderboard.leaderboards.update(server_id, stats.values())
+
+
+# Stats per server that are summed into `UserAggregateStats`.
+summed_stats = (
+    "matches_played_field",
+    "matches_played_command",
+    "matches_won_field",
+    "matches_won_command",
+    "skill_rating",
+)
+
+
+def aggregate_stats_change(
+    before: dict[str, float] | None, after: UserStats
+) -> UserAggregateStats:
+    """How a user's aggregate stats change when their `summed_stats` on one
+    server go from `before` (None for a new player) to `after`. These are
+    added to the aggregates, so `before` has to be read under
+    `db.lock_user_stats`, or concurrent ingests would add the same change
+    twice."""
+    servers_played = 0 if before else 1
+    before = before or dict.fromkeys(summed_stats, 0)
+    return UserAggregateStats(
+        user_id=after.user_id,
+        servers_played=servers_played,
+        skill_rating_sum=after.skill_rating - before["skill_rating"],
+        **{name: getattr(after, name) - before[name] for name in summed_stats[:-1]},
+    )
+
+
+def replay(
+    stats: dict[int, UserStats], server_id: int, match_updates: list[MatchUpdate]
+):
+    """Applies the match updates to `stats` in order."""
+    for match_update in match_updates:
+        apply_match(stats, server_id, match_update)
+        # Game server may use 0 or < 0 for unregistered users. They start
+        # every match without stats.
+        for user_id in [user_id for user_id in stats if user_id <= 0]:
+            del stats[user_id]
+
+
+def apply_match(stats: dict[int, UserStats], server_id: int, match_update: MatchUpdate):
+    """Updates `stats` in place, adding new stats for first-time players."""
+    user_ids_per_team = {
+        team.id: [fp.user_id for fp in team.field_players]
+        for team in match_update.teams
+    }
+    for user_id in chain(*user_ids_per_team.values()):
+        if user_id not in stats:
+            stats[user_id] = UserStats(user_id=user_id, server_id=server_id)
+    user_stats_per_team = {
+        team_id: [stats[user_id] for user_id in user_ids]
+        for team_id, user_ids in user_ids_per_team.items()
+    }
+
+    players = [
+        (team_id, us)
+        for team_id, user_stats in user_stats_per_team.items()
+        for us in user_stats
+    ]
+    new_ratings = metrics.skill_ratings(
+        [us.skill_rating for _, us in players],
+        [team_id for team_id, _ in players],
+        match_update.winner,
+    )
+    for (team_id, us), new_rating in zip(players, new_ratings.tolist()):
+        us.skill_rating = new_rating
+        us.last_seen = datetime.utcnow()
+        us.matches_played_field += 1
+        if team_id == match_update.winner:
+            us.matches_won_field += 1
+
+    # Commanders only get stats once they have played on the field.
+    for team in match_update.teams:
+        if comm_stats := stats.get(team.commander):
+            comm_stats.matches_played_command += 1
+            if team.id == match_update.winner:
+                comm_stats.matches_won_command += 1
+
+
+def compact_teams(match_update: MatchUpdate) -> list[dict]:
+    """The teams of a match update as they are kept in the match history."""
+    return [
+        dict(
+            id=team.id,
+            race=team.race.value,
+            field_players=[fp.user_id for fp in team.field_players],
+            commander=team.commander,
+        )
+        for team in match_update.teams
+    ]
+
+
+def expand_match(teams: list[dict], winner: int) -> MatchUpdate:
+    """The match update that was stored in the match history as `teams` and
+    `winner`."""
+    return MatchUpdate.parse_obj(
+        dict(
+            teams=[
+                dict(
+                    team,
+                    field_players=[
+                        dict(user_id=user_id) for user_id in team["field_players"]
+                    ],
+                )
+                for team in teams
+            ],
+            winner=winner,
+        )
+    )
+
+
+def enqueue_match(
+    session: Session,
+    server_id: int,
+    match_update: MatchUpdate,
+    idempotency_key: str | None = None,
+) -> MatchQueueItem:
+    """Stores the match update for the background worker. A known idempotency
+    key returns the item that was queued the first time instead."""
+    if idempotency_key and (
+        item := db.get_match_queue_item_by_idempotency_key(
+            session, server_id, idempotency_key
+        )
+    ):
+        return item
+    item = MatchQueueItem(
+        server_id=server_id,
+        idempotency_key=idempotency_key,
+        match_update=json.loads(match_update.json()),
+    )
+    try:
+        item = db.commit_and_refresh(session, item)
+    except IntegrityError:
+        # A retry of the same request got there first.
+        session.rollback()
+        return db.get_match_queue_item_by_idempotency_key(
+            session, server_id, idempotency_key
+        )
+    match_queue_worker.wake_up()
+    return item
+
+
+class MatchQueueWorker:
+    """Ingests queued match updates in the background, oldest first.
+
+    Game servers get a response as soon as their match is stored, instead of
+    waiting for the ratings to be updated. Each item is claimed in the same
+    transaction that writes its stats, so a crash or a second worker never
+    counts a match twice. Matches that can't be ingested, because the match
+    update is invalid, are marked with the error. Other failures, like a
+    database that is locked or unreachable, leave the item in the queue for
+    the next poll, until it has failed `max_attempts` times."""
+
+    def __init__(self, batch_size: int, poll_interval: float, max_attempts: int):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.woken = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: threading.Thread | None = None
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+
+    def wake_up(self):
+        self.woken.set()
+
+    def process(
+        self, session: Session, item_id: int, server_id: int, data: dict
+    ) -> bool:
+        """Returns False if the item is left in the queue to try again."""
+        if not db.claim_match_queue_item(session, item_id):
+            session.rollback()
+            return True
+        try:
+            ingest_match(session, server_id, MatchUpdate.parse_obj(data))
+        except ValueError as e:
+            # Including pydantic's ValidationError. The same match update
+            # would fail again.
+            session.rollback()
+            logging.exception(f"Failed to ingest queued match {item_id}")
+            db.fail_match_queue_item(session, item_id, repr(e))
+            self.failed += 1
+            return True
+        except Exception as e:
+            # Rolling back releases the claim, so the item can be tried again.
+            session.rollback()
+            attempts = db.count_match_queue_attempt(session, item_id)
+            if attempts >= self.max_attempts:
+                logging.exception(
+                    f"Giving up on queued match {item_id} after {attempts} attempts"
+                )
+                db.fail_match_queue_item(session, item_id, repr(e))
+                self.failed += 1
+                return True
+            logging.warning(
+                f"Failed to ingest queued match {item_id}, will try again",
+                exc_info=True,
+            )
+            self.retried += 1
+            return False
+        # The claim has to be committed even when ingesting wrote nothing, like
+        # for a match of only unregistered players.
+        session.commit()
+        self.processed += 1
+        return True
+
+    def drain(self):
+        """Processes batches until the queue is empty."""
+        with Session(db.engine) as session:
+            while True:
+                batch = [
+                    (item.id, item.server_id, item.match_update)
+                    for item in db.get_unprocessed_match_queue_items(
+                        session, self.batch_size
+                    )
+                ]
+                # Let go of the items, since every commit would expire them.
+                session.expunge_all()
+                done = [self.process(session, *item) for item in batch]
+                if batch:
+                    self.batches += 1
+                # Items to try again wait for the next poll, instead of being
+                # picked up again right away.
+                if len(batch) < self.batch_size or not all(done):
+                    return
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.woken.wait(self.poll_interval)
+            self.woken.clear()
+            if self.stopped.is_set():
+                return
+            try:
+                self.drain()
+            except Exception:
+                logging.exception("Failed to drain the match queue")
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Queued matches stay in the database for the next start."""
+        self.stopped.set()
+        self.woken.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def stats(self) -> dict[str, int]:
+        return dict(
+            processed=self.processed,
+            failed=self.failed,
+            retried=self.retried,
+            batches=self.batches,
+        )
+
+
+match_queue_worker = MatchQueueWorker(
+    batch_size=config.match_queue_batch_size,
+    poll_interval=config.match_queue_poll_interval.total_seconds(),
+    max_attempts=config.match_queue_max_attempts,
+)
@@ -1,3 +1,5 @@
+import numpy as np
+
 from metaserver import config
 from metaserver.database.models import UserStats
 
@@ -27,6 +29,82 @@ def skill_rating(
     return new_rating
 
 
+def scalar_skill_ratings(
+    ratings: list[float], team_ids: list[int], winner: int
+) -> list[float]:
+    """`skill_rating` for all field players of a match, one player at a time.
+    The reference that `skill_ratings` is tested and benchmarked against."""
+    ratings_per_team = {}
+    for rating, team_id in zip(ratings, team_ids):
+        ratings_per_team.setdefault(team_id, []).append(rating)
+    mean_rating_per_team = {
+        team_id: sum(team_ratings) / len(team_ratings)
+        for team_id, team_ratings in ratings_per_team.items()
+    }
+    return [
+        skill_rating(
+            current_rating=rating,
+            mean_team_rating=mean_rating_per_team[team_id],
+            mean_opponent_rating=(
+                mean_rating_per_team[winner]
+                if winner != -1
+                else sum(m for tid, m in mean_rating_per_team.items() if tid != team_id)
+                / (len(mean_rating_per_team) - 1)
+            ),
+            achieved_score=(team_id == winner) if winner != -1 else 0.5,
+        )
+        for rating, team_id in zip(ratings, team_ids)
+    ]
+
+
 def mean_skill_rating(users_stats: list[UserStats]) -> float:
     """Put this here to make it easier to implement a weighted mean later."""
     return sum([us.skill_rating for us in users_stats]) / len(users_stats)
+
+
+def skill_ratings(
+    ratings: np.ndarray,
+    team_ids: np.ndarray,
+    winner: int,
+) -> np.ndarray:
+    """Batch version of `skill_rating` for all field players of a match.
+
+    `ratings` and `team_ids` have one entry per player, `winner` is the id of
+    the winning team or -1 for a draw. Team means are accumulated in player
+    order and the opponents of a team in the order the teams first appear, so
+    every new rating is exactly what `skill_rating` would return.
+    """
+    ratings = np.asarray(ratings, dtype=float)
+    teams, first_index, team_index = np.unique(
+        np.asarray(team_ids, dtype=np.intp), return_index=True, return_inverse=True
+    )
+    mean_team_ratings = np.bincount(team_index, weights=ratings) / np.bincount(
+        team_index
+    )
+
+    # Everything that is the same for a whole team is computed once per team.
+    if winner != -1:
+        mean_opponent_ratings = np.full(
+            len(teams), mean_team_ratings[np.flatnonzero(teams == winner)[0]]
+        )
+        achieved_scores = (teams == winner).astype(float)
+    else:
+        in_order = np.argsort(first_index)
+        mean_opponent_ratings = np.array(
+            [
+                sum(mean_team_ratings[j] for j in in_order if j != i) / (len(teams) - 1)
+                for i in range(len(teams))
+            ]
+        )
+        achieved_scores = np.full(len(teams), 0.5)
+    q_opponents = 10 ** (mean_opponent_ratings / config.initial_user_skill_rating)
+
+    team_weighted_ratings = (config.lambda_ * mean_team_ratings)[team_index] + (
+        1 - config.lambda_
+    ) * ratings
+    q_players = 10 ** (team_weighted_ratings / config.initial_user_skill_rating)
+    expected_scores = q_players / (q_players + q_opponents[team_index])
+
+    return ratings + (
+        config.initial_user_skill_rating * config.skill_rating_update_step_size
+    ) / ratings * (achieved_scores[team_index] - expected_scores)
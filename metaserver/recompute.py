@@ -0,0 +1,150 @@
+"""Recomputes skill ratings from the match history, for example after changing
+`config.lambda_` or `config.skill_rating_update_step_size`.
+
+Run with `python -m metaserver.recompute`. Stats are kept per server, so every
+server's history is replayed in its own process. The new ratings are swapped in
+with one short transaction once all replays are done. The users' aggregate
+stats are summed again from their stats per server in the same transaction,
+which also repairs aggregates that drifted. Match counts per server are left
+alone.
+
+Servers are skipped when their history doesn't hold every match that their
+players' stats count, such as matches ingested before the history was kept.
+Replaying those would throw away what the missing matches did to the ratings."""
+
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+
+import metaserver.database.api as db
+from metaserver import leaderboard, matches
+from metaserver.database.models import UserStats
+
+
+def replay_ratings(
+    server_id: int,
+    history: list[tuple[list[dict], int]],
+    ratings: dict[int, float] | None = None,
+) -> dict[int, float]:
+    """Replays `(teams, winner)` pairs from the match history of a server, on
+    top of `ratings` or from scratch. Returns the skill rating of every
+    registered player in `ratings` and `history`."""
+    stats = {}
+    for user_id, rating in (ratings or {}).items():
+        stats[user_id] = UserStats(user_id=user_id, server_id=server_id)
+        # Assigned afterwards, since the constructor would round it to an int.
+        stats[user_id].skill_rating = rating
+    matches.replay(
+        stats,
+        server_id,
+        [matches.expand_match(teams, winner) for teams, winner in history],
+    )
+    return {user_id: us.skill_rating for user_id, us in stats.items()}
+
+
+def count_field_matches(history: list[tuple[list[dict], int]]) -> Counter:
+    """How many of the matches in `history` each registered player played on
+    the field, to compare with `UserStats.matches_played_field`."""
+    return Counter(
+        user_id
+        for teams, _ in history
+        for team in teams
+        for user_id in team["field_players"]
+        if user_id > 0
+    )
+
+
+def replay_server(
+    server_id: int, history: list[tuple[list[dict], int]]
+) -> tuple[dict[int, float], Counter]:
+    return replay_ratings(server_id, history), count_field_matches(history)
+
+
+def recompute_ratings(
+    engine: Engine,
+    server_ids: list[int] | None = None,
+    max_workers: int | None = None,
+) -> dict[int, int | None]:
+    """Replays the history of `server_ids`, or of every server with history, on
+    a pool of `max_workers` processes, and swaps in the new ratings. Returns
+    the number of ratings set per server, or None for servers that were
+    skipped because their history is incomplete."""
+    with Session(engine) as session, ProcessPoolExecutor(max_workers) as executor:
+        if server_ids is None:
+            server_ids = db.get_match_server_ids(session)
+        replays = {}
+        for server_id in server_ids:
+            history = db.get_matches(session, server_id)
+            replays[server_id] = (
+                history[-1].id if history else 0,
+                executor.submit(
+                    replay_server,
+                    server_id,
+                    [(match.teams, match.winner) for match in history],
+                ),
+            )
+            session.expunge_all()
+        # End the read, so the swap below sees matches ingested in the meantime.
+        session.commit()
+        # Matches keep being ingested until every replay is done.
+        results = {
+            server_id: (last_match_id, *replay.result())
+            for server_id, (last_match_id, replay) in replays.items()
+        }
+
+        # Ingesting waits from here until the commit, so no match can slip in
+        # between catching up and setting the ratings.
+        db.lock_user_stats(session)
+        ratings_set = {}
+        for server_id, (last_match_id, ratings, field_matches) in results.items():
+            # Catch up on matches that were ingested during the replay.
+            if history := [
+                (match.teams, match.winner)
+                for match in db.get_matches(session, server_id, after_id=last_match_id)
+            ]:
+                ratings = replay_ratings(server_id, history, ratings)
+                field_matches += count_field_matches(history)
+            if field_matches != db.get_matches_played_field(session, server_id):
+                ratings_set[server_id] = None
+                continue
+            db.set_skill_ratings(session, server_id, ratings)
+            ratings_set[server_id] = len(ratings)
+        db.sum_aggregate_stats(session)
+        session.commit()
+    # In case this runs in the API process. Other processes reload their
+    # leaderboards within `config.leaderboard_ttl`.
+    leaderboard.leaderboards.clear()
+    return ratings_set
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Recompute skill ratings from the match history."
+    )
+    parser.add_argument(
+        "--server-id",
+        type=int,
+        action="append",
+        dest="server_ids",
+        help="Only recompute this server. Can be given more than once.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes to replay servers on. Defaults to the number of CPUs.",
+    )
+    args = parser.parse_args()
+    for server_id, count in recompute_ratings(
+        db.engine, args.server_ids, args.workers
+    ).items():
+        if count is None:
+            print(f"Server {server_id}: skipped, its match history is incomplete")
+        else:
+            print(f"Server {server_id}: recomputed {count} skill ratings")
+
+
+if __name__ == "__main__":
+    main()
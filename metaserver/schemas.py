@@ -47,6 +47,23 @@ class UserReadWithProof(UserRead):
     that are authorized as the user that this object refers to."""
 
     proof: str
+    signed_proof: str
+
+
+class UserReadWithSession(UserReadWithProof):
+    """Object that is returned when a user logs in. The session token can be
+    used as a bearer token instead of the username and password until it
+    expires."""
+
+    session_token: str
+    session_token_expires: datetime
+
+
+class UserProof(BaseModel):
+    """A user proof as presented to a game server."""
+
+    user_id: int
+    user_proof: str
 
 
 class UserCreate(BaseModel):
@@ -159,6 +176,14 @@ class ServerLogin(BaseModel):
         json_encoders = {SecretStr: lambda v: v.get_secret_value() if v else None}
 
 
+class ServerToken(BaseModel):
+    """Returned when a server logs in. Send the token as `Authorization: Bearer
+    <token>` instead of the server username and password until it expires."""
+
+    token: str
+    expires: datetime
+
+
 class ServerCreate(BaseModel):
     host_name: utils.HttpsUrl | IPv4Address | IPv6Address
     port: int
@@ -189,6 +214,70 @@ class ServerRead(ServerCreate):
 #########
 
 
+class UserStatsColumns(BaseModel):
+    """Stats of many users on many servers, with a list per column instead of
+    an object per row, to keep responses for whole rosters small. Entry `i`
+    of every list belongs to the same user and server."""
+
+    user_id: list[int]
+    server_id: list[int]
+    first_seen: list[datetime]
+    last_seen: list[datetime]
+    matches_played_field: list[int]
+    matches_played_command: list[int]
+    matches_won_field: list[int]
+    matches_won_command: list[int]
+    skill_rating: list[int]
+
+    @classmethod
+    def from_rows(cls, rows: list[dict]) -> "UserStatsColumns":
+        return cls(**{name: [row[name] for row in rows] for name in cls.__fields__})
+
+
+class UserAggregateStatsRead(BaseModel):
+    """A user's stats summed over all servers."""
+
+    user_id: int
+    last_seen: datetime
+    servers_played: int
+    matches_played_field: int
+    matches_played_command: int
+    matches_won_field: int
+    matches_won_command: int
+    mean_skill_rating: float
+
+    class Config:
+        orm_mode = True
+
+
+class LeaderboardEntry(BaseModel):
+    """Players with the same skill rating share a rank."""
+
+    rank: int
+    user_id: int
+    skill_rating: float
+
+
+class TeamBalanceRequest(BaseModel):
+    server_id: int
+    user_ids: conlist(item_type=int, min_items=2, max_items=128, unique_items=True)
+    teams: conint(ge=2, le=4) = 2
+
+    @root_validator(skip_on_failure=True)
+    def check_enough_players(cls, values):
+        if len(values["user_ids"]) < values["teams"]:
+            raise ValueError("need at least one player per team")
+        return values
+
+
+class TeamBalance(BaseModel):
+    """Team sizes differ by at most one."""
+
+    teams: list[list[int]]
+    mean_skill_ratings: list[float]
+    skill_rating_gap: float
+
+
 class Race(str, Enum):
     human = "human"
     beast = "beast"
@@ -219,6 +308,7 @@ class MatchUpdate(BaseModel):
         if (
             (winner := values.get("winner"))
             and winner != -1
+            and "teams" in values
             and winner not in [t.id for t in values["teams"]]
         ):
             raise ValueError("winner index is not an id of one of the teams")
@@ -237,3 +327,14 @@ class MatchUpdate(BaseModel):
             ]
         ), "Teams should be disjoint"
         return values
+
+
+class MatchQueueItemRead(BaseModel):
+    id: int
+    received: datetime
+    processed: datetime | None
+    error: str | None
+    attempts: int
+
+    class Config:
+        orm_mode = True
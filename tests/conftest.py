@@ -1,9 +1,8 @@
 import pytest
 from fastapi.testclient import TestClient
-from sqlmodel import Session, SQLModel, create_engine
-from sqlmodel.pool import StaticPool
+from sqlmodel import Session, SQLModel
 
-from metaserver import email
+from metaserver import auth, email, keys, leaderboard
 import metaserver.database.api as db
 from metaserver.api import app
 from metaserver.database.models import *
@@ -13,12 +12,14 @@ from tests import utils
 
 @pytest.fixture(scope="function")
 def client():
-    db.engine = create_engine(
-        "sqlite://",
-        connect_args=dict(check_same_thread=False),
-        poolclass=StaticPool,
-    )
+    db.engine, db.async_engine = db.create_engines("sqlite://")
     SQLModel.metadata.create_all(db.engine)
+    # Forget keys from the previous test's database.
+    for key_store in [keys.user_proof_keys, keys.token_keys, keys.proof_signing_keys]:
+        key_store.reload()
+    auth.login_throttle.clear()
+    auth.deleted_servers.clear()
+    leaderboard.leaderboards.clear()
 
     with TestClient(app) as client:
         yield client
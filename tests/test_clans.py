@@ -1,6 +1,10 @@
+from datetime import datetime
+
 from fastapi.testclient import TestClient
 
-from tests.utils import dict_without_key, get_random_icon
+import metaserver.database.api as db
+from metaserver.database.models import User, UserClanLink
+from tests.utils import dict_without_key, get_random_icon, max_statements
 
 
 def test_clan_registration(client: TestClient, user: dict, clan_icon: str):
@@ -280,3 +284,60 @@ def test_clan_icon(client: TestClient, user: dict, clan_icon: str):
     )
     assert response.status_code == 200
     assert response.json()["icon"] != clan["icon"]
+
+
+def test_clan_read_paths_query_count(
+    client: TestClient, user: dict, user2: dict, clan_icon: str
+):
+    clan = client.post(
+        "/v1/clan/register",
+        json=dict(tag="Zzz", name="Zaitev's Snore Club", icon=clan_icon),
+        auth=user["auth"],
+    ).json()
+
+    # Lots of members and open invitations, and a few former members.
+    session = next(db.get_session())
+    now = datetime.utcnow()
+    for i in range(60):
+        other = User(username=f"{i}@example.com", display_name=f"{i}", key="", salt="")
+        joined = now if i % 3 else None
+        deleted = now if i % 10 == 0 else None
+        session.add(
+            UserClanLink(user=other, clan_id=clan["id"], joined=joined, deleted=deleted)
+        )
+    session.add(UserClanLink(user_id=user2["id"], clan_id=clan["id"]))
+    session.commit()
+
+    # One statement for authentication, one or two for the rest, regardless of
+    # the size of the clan.
+    with max_statements(2):
+        members = client.get(
+            "/v1/clan/members", params=dict(clan_id=clan["id"]), auth=user["auth"]
+        ).json()
+    assert len(members) == 1 + 36
+
+    with max_statements(3):
+        invites = client.get(
+            "/v1/clan/invites", params=dict(clan_id=clan["id"]), auth=user["auth"]
+        ).json()
+    assert len(invites) == 1 + 18
+
+    with max_statements(2):
+        invites = client.get("/v1/user/clan-invites", auth=user2["auth"]).json()
+    assert [link["clan_id"] for link in invites] == [clan["id"]]
+
+    with max_statements(2):
+        memberships = client.get(
+            "/v1/clan/for-user/by-id",
+            params=dict(user_id=user["id"]),
+            auth=user["auth"],
+        ).json()
+    assert [link["clan_id"] for link in memberships] == [clan["id"]]
+
+    with max_statements(3):
+        memberships = client.get(
+            "/v1/clan/for-user/by-id",
+            params=dict(user_id=user2["id"]),
+            auth=user["auth"],
+        ).json()
+    assert memberships == []
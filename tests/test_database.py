@@ -0,0 +1,150 @@
+import asyncio
+from datetime import datetime
+import itertools
+
+from sqlmodel import select
+
+from metaserver import config
+import metaserver.database.api as db
+from tests import utils
+from metaserver.database.models import User, UserClanLink, UserStats
+from metaserver.database.utils import UserClanLinkDeletedReason
+
+
+def test_sqlite_file_connection_setup(tmp_path):
+    engine, async_engine = db.create_engines(f"sqlite:///{tmp_path / 'test.db'}")
+
+    with engine.connect() as connection:
+
+        def pragma(name):
+            return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+        assert pragma("journal_mode") == "wal"
+        assert pragma("synchronous") == 1  # NORMAL
+        assert pragma("busy_timeout") == config.sqlite_pragmas["busy_timeout"]
+        assert pragma("cache_size") == config.sqlite_pragmas["cache_size"]
+
+    async def async_synchronous():
+        async with async_engine.connect() as connection:
+            result = await connection.exec_driver_sql("PRAGMA synchronous")
+            synchronous = result.scalar()
+        await async_engine.dispose()
+        return synchronous
+
+    assert asyncio.run(async_synchronous()) == 1
+
+    stats = engine.pool.stats()
+    assert stats["checkouts"] == 1
+    assert stats["checked_out"] == 0
+    assert stats["size"] == config.database_pool_size
+    engine.dispose()
+
+
+def test_pool_stats(client, server):
+    # The in-memory test database is shared with a single connection by the
+    # synchronous engine, but pooled by the asyncio engine, which server
+    # authentication uses.
+    for _ in range(3):
+        assert client.post("/v1/server/login", auth=server["auth"]).status_code == 200
+    stats = db.pool_stats()
+    assert list(stats) == ["async"]
+    assert stats["async"]["checkouts"] >= 3
+    # Requests one after the other reuse one connection.
+    assert db.async_engine.pool.checkedin() == 1
+
+
+def test_metaserver_stats(client, user, monkeypatch):
+    assert client.get("/v1/metaserver/stats").status_code == 404
+
+    monkeypatch.setattr(config, "stats_token", "operator-secret")
+    for headers in [{}, dict(Authorization="Bearer wrong")]:
+        response = client.get("/v1/metaserver/stats", headers=headers)
+        assert response.status_code == 401
+
+    client.post("/v1/user/login", auth=user["auth"])
+    response = client.get(
+        "/v1/metaserver/stats", headers=dict(Authorization="Bearer operator-secret")
+    )
+    assert response.status_code == 200
+    stats = response.json()
+    assert stats["credential_cache"]["hits"] >= 1
+    assert stats["login_throttle"]["rejected_by_username"] == 0
+    assert "flushes" in stats["last_online_buffer"]
+    assert "async" in stats["database_pools"]
+    assert set(stats) >= {"match_queue", "leaderboards"}
+
+
+def test_user_clan_link_states_in_sql(client):
+    session = next(db.get_session())
+    now = datetime.utcnow()
+    states = list(
+        itertools.product([None, now], [None, now], [None, *UserClanLinkDeletedReason])
+    )
+    for i, (joined, deleted, deleted_reason) in enumerate(states):
+        session.add(
+            UserClanLink(
+                user=User(username=f"{i}", display_name=f"{i}", key="", salt=""),
+                clan_id=1,
+                joined=joined,
+                deleted=deleted,
+                deleted_reason=deleted_reason,
+            )
+        )
+    session.commit()
+    links = session.exec(select(UserClanLink)).all()
+    assert len(links) == len(states)
+
+    # Filtering in the database agrees with the properties of loaded links.
+    for state in [
+        "is_membership",
+        "is_declined_invitation",
+        "is_open_invitation",
+        "is_retracted_invitation",
+        "user_left_clan",
+        "user_was_kicked",
+    ]:
+        in_sql = session.exec(
+            select(UserClanLink).where(getattr(UserClanLink, state))
+        ).all()
+        in_python = [link for link in links if getattr(link, state)]
+        assert in_sql and sorted(in_sql, key=id) == sorted(in_python, key=id), state
+
+    # Looking up a user's links doesn't scan the table.
+    query = select(UserClanLink).where(
+        UserClanLink.user_id == 1, UserClanLink.is_membership
+    )
+    sql = query.compile(db.engine, compile_kwargs=dict(literal_binds=True))
+    plan = session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").all()
+    assert "ix_userclanlink_user_id_state" in str(plan)
+
+
+def test_bulk_upsert(client, monkeypatch):
+    monkeypatch.setattr(db, "max_bound_parameters", 999)
+    session = next(db.get_session())
+    existing = db.bulk_upsert(session, [UserStats(user_id=1, server_id=1)])
+    assert existing[0].skill_rating == config.initial_user_skill_rating
+
+    # Updates and inserts in one go, including more rows than fit in a single
+    # statement.
+    existing[0].skill_rating = 1234
+    models = existing + [
+        UserStats(user_id=user_id, server_id=1, matches_played_field=user_id)
+        for user_id in range(2, 302)
+    ]
+    with utils.count_statements() as counter:
+        rows = db.bulk_upsert(session, models)
+    assert counter.count == 4
+    assert len(rows) == 301
+    rows = {row.user_id: row for row in rows}
+    assert rows[1].skill_rating == 1234
+    assert rows[300].matches_played_field == 300
+
+    # The last model for a primary key wins.
+    rows = db.bulk_upsert(
+        session,
+        [
+            UserStats(user_id=1, server_id=1, skill_rating=1),
+            UserStats(user_id=1, server_id=1, skill_rating=2),
+        ],
+    )
+    assert [row.skill_rating for row in rows] == [2]
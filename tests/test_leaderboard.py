@@ -0,0 +1,82 @@
+import random
+
+from fastapi.testclient import TestClient
+
+import metaserver.database.api as db
+from metaserver import leaderboard
+from metaserver.leaderboard import Leaderboard
+
+
+def test_leaderboard_order_statistics():
+    rng = random.Random(0)
+    ratings = {user_id: rng.randrange(700, 900) for user_id in range(1, 200)}
+    board = Leaderboard(ratings.items())
+    for _ in range(500):
+        user_id = rng.randrange(1, 250)
+        ratings[user_id] = rng.randrange(700, 900) + rng.random() * (user_id % 2)
+        board.update(user_id, ratings[user_id])
+
+    ordered = sorted(ratings, key=lambda user_id: (-ratings[user_id], user_id))
+    assert [entry.user_id for entry in board.top(len(ordered))] == ordered
+    for user_id in rng.sample(list(ratings), 20):
+        entry = board.rank(user_id)
+        assert entry.user_id == user_id
+        assert entry.rank == 1 + sum(r > ratings[user_id] for r in ratings.values())
+        index = ordered.index(user_id)
+        assert [entry.user_id for entry in board.around(user_id, 3)] == ordered[
+            max(0, index - 3) : index + 4
+        ]
+    assert board.rank(1000) is None
+    assert board.around(1000, 3) is None
+
+
+def test_leaderboard_routes(client: TestClient, user: dict, server: dict):
+    def match_update(winner: int) -> dict:
+        return dict(
+            teams=[
+                dict(
+                    id=team_id,
+                    race="human",
+                    field_players=[dict(user_id=user_id) for user_id in user_ids],
+                    commander=user_ids[0],
+                )
+                for team_id, user_ids in enumerate([[1, 2, 3], [4, 5, 6]])
+            ],
+            winner=winner,
+        )
+
+    client.post("/v1/server/match-update", json=match_update(0), auth=server["auth"])
+
+    def get(route: str, **params):
+        return client.get(
+            f"/v1/leaderboard/{route}",
+            params=dict(server_id=server["id"], **params),
+            auth=user["auth"],
+        )
+
+    top = get("top", n=4).json()
+    assert [entry["rank"] for entry in top] == [1, 1, 1, 4]
+    assert {entry["user_id"] for entry in top[:3]} == {1, 2, 3}
+    assert get("rank", user_id=5).json()["rank"] == 4
+    assert get("rank", user_id=7).status_code == 404
+    assert get("top", n=1000).status_code == 422
+
+    # Later matches update the loaded leaderboard instead of reloading it.
+    assert leaderboard.leaderboards.stats()["loads"] == 1
+    for _ in range(3):
+        client.post(
+            "/v1/server/match-update", json=match_update(1), auth=server["auth"]
+        )
+    session = next(db.get_session())
+    ordered = sorted(
+        db.get_skill_ratings(session, server["id"]),
+        key=lambda user_rating: (-user_rating[1], user_rating[0]),
+    )
+    top = get("top").json()
+    assert [(entry["user_id"], entry["skill_rating"]) for entry in top] == [
+        (user_id, rating) for user_id, rating in ordered
+    ]
+    index = [user_id for user_id, _ in ordered].index(4)
+    around = get("around", user_id=4, n=1).json()
+    assert around == top[max(0, index - 1) : index + 2]
+    assert leaderboard.leaderboards.stats()["loads"] == 1
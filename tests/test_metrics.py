@@ -0,0 +1,24 @@
+import random
+
+from metaserver import metrics
+
+
+def test_skill_ratings_match_scalar_version():
+    rng = random.Random(42)
+    for _ in range(500):
+        teams = rng.sample(range(4), rng.randint(2, 4))
+        team_ids = [team_id for team_id in teams for _ in range(rng.randint(1, 32))]
+        ratings = [
+            rng.choice([800, rng.randint(1, 2000), rng.uniform(1, 2000)])
+            for _ in team_ids
+        ]
+        winner = rng.choice([-1, *teams])
+        expected = metrics.scalar_skill_ratings(ratings, team_ids, winner)
+        assert metrics.skill_ratings(ratings, team_ids, winner).tolist() == expected
+
+
+def test_skill_ratings_direction():
+    ratings = metrics.skill_ratings([800, 800, 800, 800], [0, 0, 1, 1], winner=1)
+    assert ratings[0] == ratings[1] < 800 < ratings[2] == ratings[3]
+    ratings = metrics.skill_ratings([800, 800, 800, 800], [0, 0, 1, 1], winner=-1)
+    assert ratings.tolist() == [800, 800, 800, 800]
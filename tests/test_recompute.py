@@ -0,0 +1,97 @@
+import random
+
+from fastapi.testclient import TestClient
+from sqlalchemy import update
+
+import metaserver.database.api as db
+from metaserver import config, recompute
+from metaserver.database.models import UserStats
+
+
+def random_match_updates(rng: random.Random, count: int) -> list[dict]:
+    return [
+        dict(
+            teams=[
+                dict(
+                    id=team_id,
+                    race="human",
+                    field_players=[dict(user_id=user_id) for user_id in user_ids],
+                    commander=rng.choice(user_ids),
+                )
+                for team_id, user_ids in enumerate([users[:4] + [0], users[4:]])
+            ],
+            winner=rng.randrange(-1, 2),
+        )
+        for users in (rng.sample(range(1, 13), 8) for _ in range(count))
+    ]
+
+
+def test_recompute_ratings(client: TestClient, server: dict, monkeypatch):
+    client.post(
+        "/v1/server/match-update/batch",
+        json=random_match_updates(random.Random(0), 30),
+        auth=server["auth"],
+    )
+    session = next(db.get_session())
+
+    def get_ratings():
+        session.expire_all()
+        return {
+            us.user_id: us.skill_rating
+            for us in db.get_user_stats_batch(session, list(range(13)), server["id"])
+        }
+
+    ratings = get_ratings()
+    assert len(ratings) == 12
+
+    # Replaying the history with the same parameters gives the same ratings.
+    db.set_skill_ratings(session, server["id"], dict.fromkeys(ratings, 1))
+    session.commit()
+    assert recompute.recompute_ratings(db.engine, max_workers=2) == {server["id"]: 12}
+    assert get_ratings() == ratings
+
+    # Replaying part of the history and then the rest is the same as all of it.
+    history = [
+        (match.teams, match.winner) for match in db.get_matches(session, server["id"])
+    ]
+    assert len(history) == 30
+    assert (
+        recompute.replay_ratings(
+            server["id"],
+            history[20:],
+            recompute.replay_ratings(server["id"], history[:20]),
+        )
+        == ratings
+    )
+
+    # New parameters apply to the whole history.
+    monkeypatch.setattr(config, "lambda_", 0.5)
+    recompute.recompute_ratings(db.engine, [server["id"]], max_workers=2)
+    new_ratings = get_ratings()
+    assert new_ratings != ratings
+    assert new_ratings == recompute.replay_ratings(server["id"], history)
+    aggregate_stats = db.get_user_aggregate_stats(session, 1)
+    session.refresh(aggregate_stats)
+    assert aggregate_stats.mean_skill_rating == new_ratings[1]
+
+    # Aggregates that drifted from the stats per server are summed again.
+    matches_played_field = aggregate_stats.matches_played_field
+    aggregate_stats.servers_played = 2
+    aggregate_stats.matches_played_field += 1
+    session.commit()
+    recompute.recompute_ratings(db.engine, max_workers=2)
+    session.refresh(aggregate_stats)
+    assert aggregate_stats.servers_played == 1
+    assert aggregate_stats.matches_played_field == matches_played_field
+
+    # A player with matches from before the history was kept would lose
+    # their rating, so the server is left alone.
+    session.execute(
+        update(UserStats)
+        .where(UserStats.user_id == 1, UserStats.server_id == server["id"])
+        .values(matches_played_field=UserStats.matches_played_field + 1)
+    )
+    session.commit()
+    monkeypatch.setattr(config, "lambda_", 0.25)
+    assert recompute.recompute_ratings(db.engine, max_workers=2) == {server["id"]: None}
+    assert get_ratings() == new_ratings
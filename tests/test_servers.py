@@ -1,8 +1,18 @@
+from datetime import datetime
+import random
+import threading
+
 from fastapi.testclient import TestClient
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel
 
-from tests.utils import dict_without_key
+from tests.utils import dict_without_key, max_statements
 
-from metaserver import config
+from metaserver import auth, config, matches
+import metaserver.database.api as db
+from metaserver.database.models import MatchQueueItem
+from metaserver.schemas import MatchUpdate
 
 
 def test_server_registration(client: TestClient, user: dict):
@@ -312,3 +322,568 @@ def test_match_update(client: TestClient, user: dict, user2: dict, server: dict)
     )
     assert response.status_code == 200
     assert response.json()["skill_rating"] > user2_post_update
+
+
+def test_server_token(client: TestClient, user: dict, server: dict):
+    server_update = {
+        "host_name": "10.0.0.67",
+        "port": 11235,
+        "display_name": "Tokenized server",
+        "description": "This is a server that you can play on.",
+        "game_type": "RTSS",
+        "max_player_count": 32,
+        "current_player_count": 1,
+        "current_map": "eden2",
+    }
+
+    response = client.post("/v1/server/login", auth=server["auth"])
+    assert response.status_code == 200
+    headers = dict(Authorization=f"Bearer {response.json()['token']}")
+
+    response = client.post("/v1/server/update", json=server_update, headers=headers)
+    assert response.status_code == 200
+    assert response.json()["display_name"] == server_update["display_name"]
+
+    response = client.get(
+        "/v1/clan/by-id/batch", params=dict(clan_ids=[1]), headers=headers
+    )
+    assert response.status_code == 200
+
+    # Tokens are only handed out for the password.
+    response = client.post("/v1/server/login", headers=headers)
+    assert response.status_code == 401
+
+    # User session tokens aren't server tokens.
+    user_token = client.post("/v1/user/login", auth=user["auth"]).json()[
+        "session_token"
+    ]
+    response = client.post(
+        "/v1/server/update",
+        json=server_update,
+        headers=dict(Authorization=f"Bearer {user_token}"),
+    )
+    assert response.status_code == 401
+
+    response = client.post(
+        "/v1/server/update",
+        json=server_update,
+        headers=dict(Authorization="Bearer blerb"),
+    )
+    assert response.status_code == 401
+
+
+def test_deleted_server(client: TestClient, server: dict):
+    token = client.post("/v1/server/login", auth=server["auth"]).json()["token"]
+    headers = dict(Authorization=f"Bearer {token}")
+    response = client.post("/v1/server/match-update/batch", json=[], headers=headers)
+    assert response.status_code == 200
+
+    session = next(db.get_session())
+    server_row = db.get_server_by_id(session, server["id"])
+    server_row.deleted = datetime.utcnow()
+    server_row.deleted_reason = "Abuse"
+    session.commit()
+
+    # Routes that look the server up turn it away right away.
+    response = client.post("/v1/server/login", auth=server["auth"])
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Server is deleted"
+    response = client.get(
+        "/v1/clan/by-id/batch", params=dict(clan_ids=[1]), headers=headers
+    )
+    assert response.status_code == 401
+
+    # Routes that only check the token's signature do once they reload the
+    # deleted servers.
+    response = client.post("/v1/server/match-update/batch", json=[], headers=headers)
+    assert response.status_code == 200
+    auth.deleted_servers.loaded -= (
+        config.deleted_servers_reload_interval.total_seconds()
+    )
+    response = client.post("/v1/server/match-update/batch", json=[], headers=headers)
+    assert response.status_code == 401
+    assert response.json()["detail"] == "Server is deleted"
+
+
+def test_match_update_queue_retries(client: TestClient, server: dict, monkeypatch):
+    matches.match_queue_worker.stop()
+    match_update = dict(
+        teams=[
+            dict(id=0, race="human", field_players=[dict(user_id=1)], commander=1),
+            dict(id=1, race="beast", field_players=[dict(user_id=2)], commander=2),
+        ],
+        winner=0,
+    )
+    ingest_match = matches.ingest_match
+
+    def locked(*args):
+        raise OperationalError("UPDATE userstats", {}, Exception("database is locked"))
+
+    def get_item(item_id: int) -> dict:
+        return client.get(
+            "/v1/server/match-update/queue/by-id",
+            params=dict(item_id=item_id),
+            auth=server["auth"],
+        ).json()
+
+    # Database errors leave the item in the queue for the next drain.
+    item = client.post(
+        "/v1/server/match-update/queue", json=match_update, auth=server["auth"]
+    ).json()
+    monkeypatch.setattr(matches, "ingest_match", locked)
+    matches.match_queue_worker.drain()
+    item = get_item(item["id"])
+    assert item["processed"] is None
+    assert item["attempts"] == 1
+    monkeypatch.setattr(matches, "ingest_match", ingest_match)
+    matches.match_queue_worker.drain()
+    item = get_item(item["id"])
+    assert item["processed"] is not None
+    assert item["error"] is None
+
+    # But only up to a point.
+    item = client.post(
+        "/v1/server/match-update/queue", json=match_update, auth=server["auth"]
+    ).json()
+    monkeypatch.setattr(matches, "ingest_match", locked)
+    for _ in range(config.match_queue_max_attempts):
+        assert get_item(item["id"])["processed"] is None
+        matches.match_queue_worker.drain()
+    item = get_item(item["id"])
+    assert item["processed"] is not None
+    assert "database is locked" in item["error"]
+    assert item["attempts"] == config.match_queue_max_attempts
+
+
+def test_server_auth_skips_user_lookup(client: TestClient, server: dict, monkeypatch):
+    def fail(*args):
+        raise AssertionError("Server credentials shouldn't be looked up as users")
+
+    monkeypatch.setattr(db, "get_user_by_username", fail)
+    response = client.get(
+        "/v1/clan/by-id/batch", params=dict(clan_ids=[1]), auth=server["auth"]
+    )
+    assert response.status_code == 200
+
+
+def test_match_update_statement_count(client: TestClient, server: dict):
+    token = client.post("/v1/server/login", auth=server["auth"]).json()["token"]
+    match_update = dict(
+        teams=[
+            dict(
+                id=team_id,
+                race="human",
+                field_players=[
+                    dict(user_id=user_id) for user_id in range(offset, offset + 32)
+                ],
+                commander=offset,
+            )
+            for team_id, offset in [(0, 1), (1, 33)]
+        ],
+        winner=0,
+    )
+    # A lock, one read of the stats, and one write each for the stats, the
+    # aggregate stats and the match history, for new and for known players.
+    for _ in range(2):
+        with max_statements(5):
+            response = client.post(
+                "/v1/server/match-update",
+                json=match_update,
+                headers=dict(Authorization=f"Bearer {token}"),
+            )
+        assert response.status_code == 200
+
+    response = client.get(
+        "/v1/user/stats",
+        params=dict(user_id=33, server_id=server["id"]),
+        auth=server["auth"],
+    ).json()
+    assert response["matches_played_field"] == 2
+    assert response["matches_played_command"] == 2
+    assert response["matches_won_command"] == 0
+
+
+def test_concurrent_match_updates(tmp_path, monkeypatch):
+    engine, async_engine = db.create_engines(f"sqlite:///{tmp_path / 'test.db'}")
+    SQLModel.metadata.create_all(engine)
+    match_update = MatchUpdate(
+        teams=[
+            dict(id=0, race="human", field_players=[dict(user_id=1)], commander=1),
+            dict(id=1, race="beast", field_players=[dict(user_id=2)], commander=2),
+        ],
+        winner=0,
+    )
+
+    # The first ingest waits after reading the stats, to give the second one
+    # the chance to read the same stats and write before it does.
+    first_read, second_read = threading.Event(), threading.Event()
+    get_user_stats_batch = db.get_user_stats_batch
+
+    def read_and_wait(*args):
+        stats = get_user_stats_batch(*args)
+        if threading.current_thread().name == "first":
+            first_read.set()
+            second_read.wait(timeout=0.5)
+        else:
+            second_read.set()
+        return stats
+
+    monkeypatch.setattr(db, "get_user_stats_batch", read_and_wait)
+
+    def ingest():
+        with Session(engine) as session:
+            matches.ingest_match(session, 1, match_update)
+
+    first = threading.Thread(target=ingest, name="first")
+    first.start()
+    assert first_read.wait(timeout=5)
+    second = threading.Thread(target=ingest, name="second")
+    second.start()
+    first.join()
+    second.join()
+
+    # The second ingest only read the stats once the first one was done.
+    with Session(engine) as session:
+        assert len(db.get_matches(session, 1)) == 2
+        stats = db.get_user_stats_batch(session, [1, 2], 1)
+        assert [us.matches_played_field for us in stats] == [2, 2]
+        assert stats[0].matches_won_field == 2
+        assert stats[0].skill_rating > stats[1].skill_rating
+        # Nor did it add the first one's changes to the aggregates again.
+        for us in stats:
+            aggregate_stats = db.get_user_aggregate_stats(session, us.user_id)
+            assert aggregate_stats.servers_played == 1
+            assert aggregate_stats.matches_played_field == 2
+            assert aggregate_stats.matches_won_command == us.matches_won_command
+            assert aggregate_stats.skill_rating_sum == us.skill_rating
+    engine.dispose()
+
+
+def test_match_update_queue(client: TestClient, user: dict, user2: dict, server: dict):
+    # Drain by hand instead of in the background.
+    matches.match_queue_worker.stop()
+    match_update = {
+        "teams": [
+            {
+                "id": 0,
+                "race": "human",
+                "field_players": [{"user_id": user["id"]}],
+                "commander": user["id"],
+            },
+            {
+                "id": 1,
+                "race": "beast",
+                "field_players": [{"user_id": user2["id"]}],
+                "commander": 9,
+            },
+        ],
+        "winner": 0,
+    }
+
+    # Retries with the same idempotency key are only queued once.
+    headers = {"Idempotency-Key": "match-1"}
+    items = []
+    for _ in range(2):
+        response = client.post(
+            "/v1/server/match-update/queue",
+            json=match_update,
+            headers=headers,
+            auth=server["auth"],
+        )
+        assert response.status_code == 202
+        items.append(response.json())
+    assert items[0] == items[1]
+    assert items[0]["processed"] is None
+    response = client.post(
+        "/v1/server/match-update/queue", json=match_update, auth=server["auth"]
+    )
+    assert response.json()["id"] != items[0]["id"]
+
+    # Invalid match updates are rejected right away.
+    response = client.post(
+        "/v1/server/match-update/queue",
+        json=dict(match_update, winner=3),
+        auth=server["auth"],
+    )
+    assert response.status_code == 422
+
+    # Nothing happens until the worker drains the queue.
+    def get_stats(user_id):
+        return client.get(
+            "/v1/user/stats",
+            params=dict(user_id=user_id, server_id=server["id"]),
+            auth=server["auth"],
+        ).json()
+
+    assert get_stats(user["id"]) == {"detail": "Not Found"}
+    matches.match_queue_worker.drain()
+    stats = get_stats(user["id"])
+    assert stats["matches_played_field"] == 2
+    assert stats["matches_won_command"] == 2
+    response = client.get(
+        "/v1/server/match-update/queue/by-id",
+        params=dict(item_id=items[0]["id"]),
+        auth=server["auth"],
+    )
+    assert response.json()["processed"] is not None
+    assert response.json()["error"] is None
+
+    # Processed items are neither queued nor ingested again.
+    response = client.post(
+        "/v1/server/match-update/queue",
+        json=match_update,
+        headers=headers,
+        auth=server["auth"],
+    )
+    assert response.json()["id"] == items[0]["id"]
+    session = next(db.get_session())
+    matches.match_queue_worker.process(
+        session, items[0]["id"], server["id"], match_update
+    )
+    matches.match_queue_worker.drain()
+    assert get_stats(user["id"])["matches_played_field"] == 2
+
+    # Matches that can't be ingested are marked as failed.
+    item = db.commit_and_refresh(
+        session, MatchQueueItem(server_id=server["id"], match_update={})
+    )
+    matches.match_queue_worker.drain()
+    response = client.get(
+        "/v1/server/match-update/queue/by-id",
+        params=dict(item_id=item.id),
+        auth=server["auth"],
+    )
+    assert "ValidationError" in response.json()["error"]
+
+    # Matches of only unregistered players are processed once, too.
+    unregistered = dict(
+        teams=[
+            dict(id=0, race="human", field_players=[dict(user_id=0)], commander=0),
+            dict(id=1, race="beast", field_players=[dict(user_id=-1)], commander=-1),
+        ],
+        winner=0,
+    )
+    item = client.post(
+        "/v1/server/match-update/queue", json=unregistered, auth=server["auth"]
+    ).json()
+    matches.match_queue_worker.drain()
+    response = client.get(
+        "/v1/server/match-update/queue/by-id",
+        params=dict(item_id=item["id"]),
+        auth=server["auth"],
+    )
+    assert response.json()["processed"] is not None
+    assert db.get_unprocessed_match_queue_items(session, 10) == []
+
+
+def test_match_update_batch(client: TestClient, user: dict, server: dict):
+    # A second server gets the same matches one by one.
+    client.post(
+        "/v1/server/register",
+        json=dict(
+            host_name="https://example.org",
+            port=11236,
+            display_name="Zaitev's Other Server",
+            description="Welcome back.",
+            game_type="Snoozing",
+            max_player_count=42,
+        ),
+        auth=user["auth"],
+    )
+    server2_id = next(
+        s["id"]
+        for s in client.get("/v1/server/list/my", auth=user["auth"]).json()
+        if s["id"] != server["id"]
+    )
+
+    rng = random.Random(0)
+    match_updates = [
+        dict(
+            teams=[
+                dict(
+                    id=team_id,
+                    race="human",
+                    field_players=[dict(user_id=user_id) for user_id in user_ids],
+                    commander=rng.choice(user_ids + [0]),
+                )
+                for team_id, user_ids in enumerate([users[:4] + [0], users[4:] + [-1]])
+            ],
+            winner=rng.randrange(-1, 2),
+        )
+        for users in (rng.sample(range(1, 13), 8) for _ in range(20))
+    ]
+
+    token = client.post("/v1/server/login", auth=server["auth"]).json()["token"]
+    with max_statements(5):
+        response = client.post(
+            "/v1/server/match-update/batch",
+            json=match_updates,
+            headers=dict(Authorization=f"Bearer {token}"),
+        )
+    assert response.status_code == 200
+
+    session = next(db.get_session())
+    for match_update in match_updates:
+        matches.ingest_match(session, server2_id, MatchUpdate.parse_obj(match_update))
+
+    def get_stats(server_id):
+        return [
+            dict_without_key(us.dict(exclude={"first_seen", "last_seen"}), "server_id")
+            for us in db.get_user_stats_batch(session, list(range(13)), server_id)
+        ]
+
+    assert len(get_stats(server["id"])) == 12
+    assert get_stats(server["id"]) == get_stats(server2_id)
+
+    response = client.post(
+        "/v1/server/match-update/batch",
+        json=match_updates[:1] * (config.match_update_batch_max_size + 1),
+        headers=dict(Authorization=f"Bearer {token}"),
+    )
+    assert response.status_code == 422
+
+
+def test_user_aggregate_stats(client: TestClient, user: dict, server: dict):
+    client.post(
+        "/v1/server/register",
+        json=dict(
+            host_name="https://example.org",
+            port=11236,
+            display_name="Zaitev's Other Server",
+            description="Welcome back.",
+            game_type="Snoozing",
+            max_player_count=42,
+        ),
+        auth=user["auth"],
+    )
+    server2_id = next(
+        s["id"]
+        for s in client.get("/v1/server/list/my", auth=user["auth"]).json()
+        if s["id"] != server["id"]
+    )
+
+    rng = random.Random(1)
+    for server_id in [server["id"], server2_id]:
+        session = next(db.get_session())
+        for _ in range(10):
+            users = rng.sample(range(1, 9 if server_id == server["id"] else 13), 6)
+            matches.ingest_match(
+                session,
+                server_id,
+                MatchUpdate(
+                    teams=[
+                        dict(
+                            id=team_id,
+                            race="beast",
+                            field_players=[dict(user_id=u) for u in user_ids],
+                            commander=rng.choice(users),
+                        )
+                        for team_id, user_ids in enumerate([users[:3], users[3:]])
+                    ],
+                    winner=rng.randrange(-1, 2),
+                ),
+            )
+
+    session = next(db.get_session())
+    with max_statements(2):
+        response = client.get(
+            "/v1/user/stats/aggregate/batch",
+            params=dict(user_ids=list(range(0, 14))),
+            auth=user["auth"],
+        )
+    aggregates = response.json()
+    assert [a["user_id"] for a in aggregates] == list(range(1, 13))
+    for aggregate in aggregates:
+        stats = [
+            us
+            for server_id in [server["id"], server2_id]
+            for us in db.get_user_stats_batch(
+                session, [aggregate["user_id"]], server_id
+            )
+        ]
+        assert aggregate["servers_played"] == len(stats)
+        for name in [
+            "matches_played_field",
+            "matches_played_command",
+            "matches_won_field",
+            "matches_won_command",
+        ]:
+            assert aggregate[name] == sum(getattr(us, name) for us in stats)
+        assert aggregate["mean_skill_rating"] == pytest.approx(
+            sum(us.skill_rating for us in stats) / len(stats)
+        )
+
+    response = client.get(
+        "/v1/user/stats/aggregate", params=dict(user_id=1), auth=user["auth"]
+    )
+    assert response.json() == aggregates[0]
+    response = client.get(
+        "/v1/user/stats/aggregate", params=dict(user_id=13), auth=user["auth"]
+    )
+    assert response.status_code == 404
+    response = client.get(
+        "/v1/user/stats/aggregate/batch",
+        params=dict(user_ids=list(range(config.user_stats_batch_max_size + 1))),
+        auth=user["auth"],
+    )
+    assert response.status_code == 422
+
+
+def test_user_stats_batch(client: TestClient, user: dict, server: dict):
+    session = next(db.get_session())
+    matches.ingest_match(
+        session,
+        server["id"],
+        MatchUpdate(
+            teams=[
+                dict(
+                    id=team_id,
+                    race="human",
+                    field_players=[dict(user_id=u) for u in user_ids],
+                    commander=user_ids[0],
+                )
+                for team_id, user_ids in enumerate([[1, 2, 3], [4, 5, 6]])
+            ],
+            winner=1,
+        ),
+    )
+
+    # One statement for authentication and one for all stats.
+    with max_statements(2):
+        response = client.get(
+            "/v1/user/stats/batch",
+            params=dict(user_ids=[6, 2, 7, 4], server_ids=[server["id"], 1000]),
+            auth=user["auth"],
+        )
+    columns = response.json()
+    assert columns["user_id"] == [2, 4, 6]
+    assert columns["server_id"] == [server["id"]] * 3
+    assert columns["matches_won_field"] == [0, 1, 1]
+    assert columns["matches_played_command"] == [0, 1, 0]
+    expected = [
+        client.get(
+            "/v1/user/stats",
+            params=dict(user_id=user_id, server_id=server["id"]),
+            auth=user["auth"],
+        ).json()
+        for user_id in [2, 4, 6]
+    ]
+    assert [
+        {name: values[i] for name, values in columns.items()} for i in range(3)
+    ] == expected
+
+    response = client.get(
+        "/v1/user/stats/batch",
+        params=dict(user_ids=[7], server_ids=[server["id"]]),
+        auth=user["auth"],
+    )
+    assert all(values == [] for values in response.json().values())
+    response = client.get(
+        "/v1/user/stats/batch",
+        params=dict(
+            user_ids=list(range(config.user_stats_batch_max_size + 1)),
+            server_ids=[server["id"]],
+        ),
+        auth=user["auth"],
+    )
+    assert response.status_code == 422
@@ -2,7 +2,7 @@ from fastapi.testclient import TestClient
 
 import metaserver.database.api as db
 import metaserver.database.models as models
-from tests.utils import dict_without_key
+from tests.utils import dict_without_key, max_statements
 
 
 def test_user_skins(client: TestClient, user: dict):
@@ -77,3 +77,35 @@ def test_clan_skins(client: TestClient, user: dict, clan_icon: str):
         auth=user["auth"],
     )
     assert response.json() == []
+
+
+def test_skin_read_paths_query_count(client: TestClient, user: dict, clan_icon: str):
+    clan = client.post(
+        "/v1/clan/register",
+        json=dict(tag="Zzz", name="Zaitev's Snore Club", icon=clan_icon),
+        auth=user["auth"],
+    ).json()
+    session = next(db.get_session())
+    for i in range(20):
+        skin = models.Skin(kind="shield", unit="lego", model_path=f"{i}.model")
+        session.add(models.UserSkinLink(user_id=user["id"], skin=skin))
+        skin = models.Skin(kind="shield", unit="lego", model_path=f"clan/{i}.model")
+        session.add(models.ClanSkinLink(clan_id=clan["id"], skin=skin))
+    session.commit()
+
+    # One statement for authentication and one per kind of skin.
+    with max_statements(3):
+        response = client.get(
+            "/v1/skin/for-user/by-id",
+            params=dict(user_id=user["id"], clan_id=clan["id"]),
+            auth=user["auth"],
+        )
+    assert len(response.json()) == 40
+
+    with max_statements(2):
+        response = client.get(
+            "/v1/skin/for-clan/by-id",
+            params=dict(clan_id=clan["id"]),
+            auth=user["auth"],
+        )
+    assert len(response.json()) == 20
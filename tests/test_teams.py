@@ -0,0 +1,88 @@
+from itertools import combinations
+import random
+
+from fastapi.testclient import TestClient
+import numpy as np
+
+import metaserver.database.api as db
+from metaserver import config, matches, teams
+from metaserver.schemas import MatchUpdate
+from tests.utils import max_statements
+
+
+def gap(ratings: list[float], members: list[list[int]]) -> float:
+    means = teams.mean_ratings(ratings, members)
+    return max(means) - min(means)
+
+
+def test_balance_teams():
+    rng = random.Random(0)
+    for n, k in [(7, 2), (16, 2), (30, 3), (64, 4), (5, 4)]:
+        ratings = [rng.gauss(800, 150) for _ in range(n)]
+        members = teams.balance_teams(ratings, k)
+        assert sorted(p for team in members for p in team) == list(range(n))
+        assert sorted(len(team) for team in members) == sorted(teams.team_sizes(n, k))
+        assert gap(ratings, members) <= gap(ratings, teams.deal(np.array(ratings), k))
+
+    # Within a rating point of the best split, found by trying them all.
+    for _ in range(5):
+        ratings = [rng.gauss(800, 150) for _ in range(14)]
+        members = teams.balance_teams(ratings, 2)
+        best = min(
+            gap(ratings, [list(team), [p for p in range(14) if p not in team]])
+            for team in combinations(range(14), 7)
+        )
+        assert gap(ratings, members) <= best + 1
+
+    assert teams.balance_teams([1000, 900, 800, 700], 2) == [[0, 3], [1, 2]]
+
+
+def test_balance_teams_route(client: TestClient, user: dict, server: dict):
+    session = next(db.get_session())
+    matches.ingest_match(
+        session,
+        server["id"],
+        MatchUpdate(
+            teams=[
+                dict(id=0, race="human", field_players=[dict(user_id=1)], commander=1),
+                dict(id=1, race="beast", field_players=[dict(user_id=2)], commander=2),
+            ],
+            winner=0,
+        ),
+    )
+    ratings = dict(db.get_skill_ratings(session, server["id"]))
+    assert ratings[1] > config.initial_user_skill_rating > ratings[2]
+
+    # One statement for authentication and one for all ratings.
+    with max_statements(2):
+        response = client.post(
+            "/v1/server/balance-teams",
+            json=dict(server_id=server["id"], user_ids=[1, 2, 3, 4]),
+            auth=user["auth"],
+        )
+    balance = response.json()
+    assert sorted(map(sorted, balance["teams"])) == [[1, 2], [3, 4]]
+    assert balance["skill_rating_gap"] == 0
+
+    response = client.post(
+        "/v1/server/balance-teams",
+        json=dict(server_id=server["id"], user_ids=[1, 2, 3], teams=4),
+        auth=user["auth"],
+    )
+    assert response.status_code == 422
+
+    # Players that are new to the server all count with the initial rating.
+    response = client.post(
+        "/v1/server/balance-teams",
+        json=dict(server_id=server["id"], user_ids=[5, 6, 7]),
+        auth=user["auth"],
+    )
+    assert response.status_code == 200
+    assert response.json()["skill_rating_gap"] == 0
+
+    response = client.post(
+        "/v1/server/balance-teams",
+        json=dict(server_id=server["id"] + 1, user_ids=[1, 2, 3]),
+        auth=user["auth"],
+    )
+    assert response.status_code == 404
@@ -1,6 +1,14 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
 from fastapi.testclient import TestClient
+from sqlmodel import select
 
-from metaserver import email
+from metaserver import auth, config, email, keys
+import metaserver.database.api as db
+from metaserver.database.models import User
 
 from tests import utils
 
@@ -245,3 +253,356 @@ def test_get_user_batch(client: TestClient, user: dict, user2: dict):
     assert type(resp) == list
     assert len(resp) == 2
     assert [u["id"] for u in resp] == [user["id"], user2["id"]]
+
+
+def test_credential_cache(client: TestClient, user: dict):
+    auth.credential_cache.clear()
+
+    # The first request pays for hashing, the second one doesn't.
+    for _ in range(2):
+        response = client.post("/v1/user/login", auth=user["auth"])
+        assert response.status_code == 200
+    assert auth.credential_cache.hits == 1
+    assert auth.credential_cache.misses == 1
+
+    # Wrong passwords are never cached.
+    for _ in range(2):
+        response = client.post("/v1/user/login", auth=(user["auth"][0], "wrongpass"))
+        assert response.status_code == 401
+    assert auth.credential_cache.hits == 1
+    assert auth.credential_cache.misses == 3
+
+    # Cached credentials don't let deleted users in.
+    session = next(db.get_session())
+    user_obj = db.get_user_by_id(session, user["id"])
+    user_obj.deleted = datetime.utcnow()
+    db.commit_and_refresh(session, user_obj)
+    response = client.post("/v1/user/login", auth=user["auth"])
+    assert response.status_code == 401
+    assert auth.credential_cache.hits == 2
+
+
+def test_failed_login_throttle(
+    client: TestClient, user: dict, user2: dict, monkeypatch
+):
+    response = client.post("/v1/user/login", auth=user["auth"])
+    assert response.status_code == 200
+    wrong_auth = (user["auth"][0], "wrongpass")
+    for _ in range(config.failed_login_burst):
+        response = client.post("/v1/user/login", auth=wrong_auth)
+        assert response.status_code == 401
+
+    # Failures sent in a user's name don't lock out clients whose credentials
+    # are cached.
+    response = client.post("/v1/user/login", auth=user["auth"])
+    assert response.status_code == 200
+    assert auth.login_throttle.stats()["rejected_by_username"] == 0
+
+    # Other attempts are rejected before the password is hashed, also when the
+    # password is right.
+    auth.credential_cache.clear()
+
+    def hash_password(password, salt):
+        raise AssertionError("Throttled passwords are not hashed")
+
+    with monkeypatch.context() as m:
+        m.setattr(auth.password_hasher, "hash", hash_password)
+        response = client.post("/v1/user/login", auth=user["auth"])
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+    assert auth.login_throttle.stats()["rejected_by_username"] == 1
+
+    # Other users from the same address are throttled too.
+    response = client.post("/v1/user/login", auth=user2["auth"])
+    assert response.status_code == 429
+    assert auth.login_throttle.stats()["rejected_by_client"] == 1
+
+    # But not from other addresses.
+    auth.login_throttle.buckets.pop("client:testclient")
+    response = client.post("/v1/user/login", auth=user2["auth"])
+    assert response.status_code == 200
+
+    # Attempts trickle back over time.
+    tokens, updated = auth.login_throttle.buckets[f"username:{user['auth'][0]}"]
+    auth.login_throttle.buckets[f"username:{user['auth'][0]}"] = (
+        tokens,
+        updated - config.failed_login_refill_interval.total_seconds(),
+    )
+    response = client.post("/v1/user/login", auth=user["auth"])
+    assert response.status_code == 200
+
+
+def test_trusted_forwarded_header(client: TestClient, user: dict, monkeypatch):
+    wrong_auth = (user["auth"][0], "wrongpass")
+    headers = {"X-Forwarded-For": "10.0.0.1, 192.0.2.7"}
+
+    # Ignored unless configured, since clients can send anything.
+    client.post("/v1/user/login", auth=wrong_auth, headers=headers)
+    assert "client:testclient" in auth.login_throttle.buckets
+
+    # The proxy appends the address it saw, after whatever the client sent.
+    monkeypatch.setattr(config, "trusted_forwarded_header", "X-Forwarded-For")
+    client.post("/v1/user/login", auth=wrong_auth, headers=headers)
+    assert "client:192.0.2.7" in auth.login_throttle.buckets
+    assert "client:10.0.0.1" not in auth.login_throttle.buckets
+
+
+def test_password_hasher_pool():
+    hasher = auth.PasswordHasher(workers=1)
+    try:
+        expected = auth.hash_password("12345678", "salt")
+        assert hasher.hash("12345678", "salt") == expected
+        assert asyncio.run(hasher.hash_async("12345678", "salt")) == expected
+    finally:
+        hasher.shutdown()
+
+
+def test_session_token(client: TestClient, user: dict, monkeypatch):
+    response = client.post("/v1/user/login", auth=user["auth"])
+    assert response.status_code == 200
+    token = response.json()["session_token"]
+    headers = dict(Authorization=f"Bearer {token}")
+
+    # Routes that only need the user's identity.
+    response = client.get(
+        "/v1/user/by-id", params=dict(user_id=user["id"]), headers=headers
+    )
+    assert response.status_code == 200
+    assert response.json()["id"] == user["id"]
+
+    # Routes that need the user itself.
+    response = client.post(
+        "/v1/user/change-display-name",
+        json=dict(display_name="bar"),
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert response.json()["display_name"] == "bar"
+
+    # But a session token can't be used to log in again for a new one.
+    response = client.post("/v1/user/login", headers=headers)
+    assert response.status_code == 401
+
+    # Tampered tokens are rejected.
+    kind, user_id, expires, kid, signature = token.split(".")
+    for bad_token in [
+        f"{kind}.{user_id}.{int(expires) + 1000}.{kid}.{signature}",
+        f"server.{user_id}.{expires}.{kid}.{signature}",
+        "blerb",
+    ]:
+        response = client.get(
+            "/v1/user/by-id",
+            params=dict(user_id=user["id"]),
+            headers=dict(Authorization=f"Bearer {bad_token}"),
+        )
+        assert response.status_code == 401
+
+    # Expired tokens are rejected.
+    monkeypatch.setattr(config, "session_token_ttl", timedelta(minutes=-1))
+    token = client.post("/v1/user/login", auth=user["auth"]).json()["session_token"]
+    response = client.get(
+        "/v1/user/by-id",
+        params=dict(user_id=user["id"]),
+        headers=dict(Authorization=f"Bearer {token}"),
+    )
+    assert response.status_code == 401
+
+
+def test_user_proof_batch(client: TestClient, user: dict, user2: dict):
+    last_online_0 = [
+        u["last_online"]
+        for u in client.get(
+            "/v1/user/by-id/batch",
+            params=dict(user_ids=[user["id"], user2["id"]]),
+            auth=user["auth"],
+        ).json()
+    ]
+
+    response = client.post(
+        "/v1/user/verify-user-proof/batch",
+        json=dict(
+            proofs=[
+                dict(user_id=user["id"], user_proof=user["proof"]),
+                dict(user_id=user2["id"], user_proof="blerb"),
+            ]
+        ),
+    )
+    assert response.status_code == 200
+    assert response.json() == [True, False]
+
+    # Only the verified user's last online datetime was updated.
+    last_online_1 = [
+        u["last_online"]
+        for u in client.get(
+            "/v1/user/by-id/batch",
+            params=dict(user_ids=[user["id"], user2["id"]]),
+            auth=user["auth"],
+        ).json()
+    ]
+    assert last_online_1[0] > last_online_0[0]
+    assert last_online_1[1] == last_online_0[1]
+
+    response = client.post("/v1/user/verify-user-proof/batch", json=dict(proofs=[]))
+    assert response.status_code == 422
+
+
+def test_signed_user_proof(client: TestClient, user: dict, monkeypatch):
+    response = client.post("/v1/user/login", auth=user["auth"])
+    signed_proof = response.json()["signed_proof"]
+
+    # The metaserver accepts signed proofs too.
+    response = client.post(
+        "/v1/user/verify-user-proof",
+        json=dict(user_id=user["id"], user_proof=signed_proof),
+    )
+    assert response.json() == True
+
+    # But only for the user they were issued to.
+    response = client.post(
+        "/v1/user/verify-user-proof",
+        json=dict(user_id=user["id"] + 1, user_proof=signed_proof),
+    )
+    assert response.json() == False
+
+    # Game servers can verify them offline with the published keys.
+    jwks = client.get("/.well-known/user-proof-keys.json").json()
+    payload, _, signature = signed_proof.rpartition(".")
+    kid = payload.split(".")[0]
+    (jwk,) = [k for k in jwks["keys"] if k["kid"] == kid]
+    public_key = Ed25519PublicKey.from_public_bytes(keys.b64decode(jwk["x"]))
+    public_key.verify(keys.b64decode(signature), payload.encode("utf-8"))
+
+    # Proofs signed with a retired key stay valid until they could have
+    # expired, however often the keys rotate.
+    keys.proof_signing_keys.rotate()
+    assert auth.verify_user_proof(user["id"], signed_proof)
+    assert len(client.get("/.well-known/user-proof-keys.json").json()["keys"]) == 2
+    keys.proof_signing_keys.rotate()
+    assert auth.verify_user_proof(user["id"], signed_proof)
+    monkeypatch.setattr(
+        keys.proof_signing_keys,
+        "signed_ttl",
+        -keys.proof_signing_keys.reload_interval - 1,
+    )
+    keys.proof_signing_keys.rotate()
+    assert not auth.verify_user_proof(user["id"], signed_proof)
+    assert len(client.get("/.well-known/user-proof-keys.json").json()["keys"]) == 1
+
+    # Tampering with the expiry invalidates the signature.
+    signed_proof = auth.generate_signed_user_proof(user["id"])
+    kid, user_id, expires, signature = signed_proof.split(".")
+    tampered = f"{kid}.{user_id}.{int(expires) + 1000}.{signature}"
+    assert not auth.verify_user_proof(user["id"], tampered)
+    assert not auth.verify_user_proof(user["id"], "not.a.valid.proof")
+
+
+def test_user_proof_expiry(user: dict, monkeypatch):
+    # Proofs carry their own expiry, somewhere within the jitter window.
+    now = time.time()
+    expiries = [
+        int(auth.generate_user_proof(user["id"]).split(".")[1]) for _ in range(20)
+    ]
+    ttl = config.user_proof_ttl.total_seconds()
+    jitter = config.user_proof_ttl_jitter.total_seconds()
+    assert all(now + ttl - 1 <= e <= now + ttl + jitter + 1 for e in expiries)
+    assert len(set(expiries)) > 1
+
+    # Any unexpired proof is accepted, not just the current minute's.
+    proof = auth.generate_user_proof(user["id"])
+    monkeypatch.setattr(time, "time", lambda: now + ttl - 1)
+    assert auth.verify_user_proof(user["id"], proof)
+    monkeypatch.setattr(time, "time", lambda: now + ttl + jitter + 1)
+    assert not auth.verify_user_proof(user["id"], proof)
+
+
+def test_user_proof_keys_are_shared_between_workers(client: TestClient, user: dict):
+    # Two workers that share a database.
+    worker_0 = keys.KeyStore("test", **keys.key_store_kwargs(timedelta(hours=1)))
+    worker_1 = keys.KeyStore("test", **keys.key_store_kwargs(timedelta(hours=1)))
+
+    kid, secret = worker_0.active()
+    assert worker_1.get(kid) == secret
+    assert worker_1.active() == (kid, secret)
+
+    # After a rotation by one worker, the other picks up the new key as soon as
+    # it sees it, and both still know the previous key. Unknown kids cause a
+    # reload at most once a second.
+    worker_0.rotate()
+    new_kid, new_secret = worker_0.active()
+    assert new_kid != kid
+    assert worker_1.get(new_kid) is None
+    worker_1.loaded -= 1
+    assert worker_1.get(new_kid) == new_secret
+    assert worker_1.get(kid) == secret
+
+    # Keys older than the rotation interval are replaced on first use.
+    worker_1.rotation_interval = -1
+    newest_kid = worker_1.active()[0]
+    assert newest_kid not in [kid, new_kid]
+    worker_0.reload()
+    assert worker_0.get(kid) == secret
+
+    # Retired keys are deleted once what they signed has expired.
+    worker_1.signed_ttl = -worker_1.reload_interval - 1
+    worker_1.rotate()
+    worker_0.reload()
+    assert [worker_0.get(k) for k in [kid, new_kid, newest_kid]] == [None] * 3
+
+
+def test_concurrent_key_rotation(client: TestClient):
+    worker_0 = keys.KeyStore("test", **keys.key_store_kwargs(timedelta(hours=1)))
+    worker_1 = keys.KeyStore("test", **keys.key_store_kwargs(timedelta(hours=1)))
+    kid, secret = worker_0.active()
+
+    # Both workers see the key as due for rotation.
+    session = next(db.get_session())
+    (key,) = db.get_secret_keys(session, "test")
+    key.created -= 2 * config.secret_key_rotation_interval
+    session.add(key)
+    session.commit()
+    worker_0.reload()
+    worker_1.reload()
+
+    # The second one to rotate finds the first one's new key in the database,
+    # and the key that was active before stays.
+    new_kid, _ = worker_0.active()
+    assert worker_1.active()[0] == new_kid != kid
+    assert [key.id for key in db.get_secret_keys(session, "test")] == [kid, new_kid]
+    assert worker_1.get(kid) == secret
+
+
+def test_last_online_buffer(client: TestClient, user: dict, user2: dict):
+    db.last_online_buffer.flush()
+
+    def stored_last_online(user_id):
+        session = next(db.get_session())
+        return session.exec(select(User.last_online).where(User.id == user_id)).one()
+
+    before = stored_last_online(user["id"]), stored_last_online(user2["id"])
+    response = client.post(
+        "/v1/user/verify-user-proof/batch",
+        json=dict(
+            proofs=[
+                dict(user_id=user["id"], user_proof=user["proof"]),
+                dict(user_id=user2["id"], user_proof=user2["proof"]),
+            ]
+        ),
+    )
+    assert response.json() == [True, True]
+
+    # Not written yet, but the API already shows it.
+    assert (stored_last_online(user["id"]), stored_last_online(user2["id"])) == before
+    response = client.get(
+        "/v1/user/by-id", params=dict(user_id=user["id"]), auth=user["auth"]
+    )
+    assert response.json()["last_online"] > before[0].isoformat()
+
+    # Both users are written with a single statement.
+    flushes = db.last_online_buffer.flushes
+    with utils.count_statements() as counter:
+        db.last_online_buffer.flush()
+    assert counter.count == 1
+    assert db.last_online_buffer.flushes == flushes + 1
+    assert stored_last_online(user["id"]) > before[0]
+    assert stored_last_online(user2["id"]) > before[1]
+    assert db.last_online_buffer.stats()["pending"] == 0
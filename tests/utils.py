@@ -1,10 +1,12 @@
 import base64
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import io
 import random
 
 from fastapi.testclient import TestClient
 from PIL import Image
+from sqlalchemy import event
 from sqlmodel import select
 
 from metaserver import email
@@ -67,3 +69,32 @@ def get_random_icon(width: int, height: int) -> str:
     buff = io.BytesIO()
     img.save(buff, "PNG")
     return base64.b64encode(buff.getvalue()).decode("utf-8")
+
+
+class StatementCounter:
+    count = 0
+
+
+@contextmanager
+def count_statements():
+    """Count the SQL statements sent to the database inside the block."""
+    counter = StatementCounter()
+
+    def count(*args):
+        counter.count += 1
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+@contextmanager
+def max_statements(limit: int):
+    """Fail if the block sends more than `limit` SQL statements to the
+    database."""
+    with count_statements() as counter:
+        yield counter
+    assert counter.count <= limit, f"{counter.count} statements, at most {limit}"